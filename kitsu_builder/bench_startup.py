@@ -0,0 +1,98 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+"""
+Startup benchmark of kitsu_builder.py: the import time of the module from
+python -X importtime, and the wall time of cold runs of the common commands.
+
+Pass --against <git revision> to run the same benchmark on an older version
+of the script, like the one before the lazy imports.
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def commands(folder: str, dev_env: str) -> Dict[str, List[str]]:
+    script = os.path.join(folder, "kitsu_builder.py")
+    return {
+        "import kitsu_builder": ["-c", "import kitsu_builder"],
+        "--help": [script, "--help"],
+        "tools --stop-helper": [script, "tools", "--dev-path", dev_env, "--stop-helper"],
+    }
+
+
+def import_times(folder: str) -> Dict[str, int]:
+    # Cumulative import time in microseconds of kitsu_builder and of the modules it imports directly
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import kitsu_builder"], cwd=folder, capture_output=True, text=True)
+    # Every import is printed after the ones it caused, indented two spaces deeper than them
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        entries.append(((len(name) - len(name.lstrip())) // 2, name.strip(), int(cumulative)))
+    times = {}
+    for depth, name, cumulative in reversed(entries):
+        if name == "kitsu_builder":
+            times[name] = cumulative
+        elif times and depth == 0:
+            # The imports before kitsu_builder are the ones of the interpreter startup
+            break
+        elif times and depth == 1:
+            times[name] = cumulative
+    return times
+
+
+def wall_times(folder: str, dev_env: str, runs: int) -> Dict[str, float]:
+    # Median of cold runs, in milliseconds
+    medians = {}
+    for name, args in commands(folder, dev_env).items():
+        samples = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, *args], cwd=folder, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            samples.append((time.perf_counter() - started) * 1000)
+        medians[name] = statistics.median(samples)
+    return medians
+
+
+def bench(folder: str, dev_env: str, runs: int) -> tuple:
+    return import_times(folder), wall_times(folder, dev_env, runs)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the startup time of kitsu_builder.py.")
+    parser.add_argument("--runs", type=int, default=30, help="Cold runs of each command, the median is reported.")
+    parser.add_argument("--against", type=str, help="Also benchmark kitsu_builder.py at this git revision.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # An empty dev env, so tools --stop-helper only finds that no helper is running
+        dev_env = os.path.join(tmp, "dev")
+        os.makedirs(dev_env)
+        results = {"current": bench(HERE, dev_env, args.runs)}
+        if args.against is not None:
+            old = os.path.join(tmp, "old")
+            os.makedirs(old)
+            source = subprocess.run(["git", "show", f"{args.against}:./kitsu_builder.py"], cwd=HERE, capture_output=True, check=True).stdout
+            with open(os.path.join(old, "kitsu_builder.py"), "wb") as f:
+                f.write(source)
+            results[args.against] = bench(old, dev_env, args.runs)
+
+    for version, (imports, walls) in results.items():
+        print(f"{version}:")
+        print(f"  import kitsu_builder (cumulative, -X importtime) {imports.get('kitsu_builder', 0) / 1000:7.1f}ms")
+        heaviest = sorted(((took, name) for name, took in imports.items() if name != "kitsu_builder"), reverse=True)[:5]
+        print(f"  heaviest imports: {', '.join(f'{name} {took / 1000:.1f}ms' for took, name in heaviest)}")
+        for name, took in walls.items():
+            print(f"  {name:<48} {took:7.1f}ms  (median of {args.runs} runs)")
+
+
+if __name__ == "__main__":
+    main()
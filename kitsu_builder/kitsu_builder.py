@@ -1,19 +1,79 @@
 import argparse
-import gzip
+import fcntl
+import hashlib
+import json
 import os
-import requests
+import queue
+import re
+import socket
 import sys
 import subprocess
+import threading
+import time
+import zlib
 from colorama import Fore, Style
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
 from getpass import getuser
-from ruamel import yaml
-from shutil import which, copyfileobj, rmtree
-from tqdm import tqdm
+from shutil import which, rmtree
 from typing import (
+    TYPE_CHECKING,
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
     Optional
 )
 
+# requests, tqdm and ruamel.yaml take most of the startup time, so they're only
+# imported by the functions that use them
+if TYPE_CHECKING:
+    import requests
+    from tqdm import tqdm
+
+KITSU_DB_DUMP = "https://f002.backblazeb2.com/file/kitsu-dumps/latest.sql.gz"
+KITSU_API = "http://kitsu.localhost:42069/api/edge"
+# How long to wait for the services of the dev env to be ready
+READY_TIMEOUT = 10 * 60
+# Tools run against an already started dev env, so they don't wait as long as setup
+TOOLS_READY_TIMEOUT = 20
+# Readiness checks are retried after READY_MIN_DELAY seconds, doubling up to READY_MAX_DELAY
+READY_MIN_DELAY = 0.25
+READY_MAX_DELAY = 2
+# Port of typesense inside its container
+TYPESENSE_PORT = 8108
+# Where git mirrors and DB dumps are cached between runs, None disables the cache
+CACHE_DIR: Optional[str] = os.environ.get("KITSU_BUILDER_CACHE", os.path.expanduser("~/.cache/kitsu-builder"))
+# Accounts created at the same time by tools --create-user
+ACCOUNT_WORKERS = 8
+# Database snapshots are saved as template databases named with this prefix
+SNAPSHOT_PREFIX = "kitsu_snapshot_"
+# Fingerprints of the setup steps, relative to the dev env folder
+SETUP_STATE = ".kitsu-builder/state.json"
+# Socket of the warm helper, relative to the dev env folder
+HELPER_SOCKET = ".kitsu-builder/helper.sock"
+# The helper stops after this many seconds without requests
+HELPER_IDLE_TIMEOUT = 30 * 60
+# Printed by the warm sessions after every request, followed by ok/error, or dead when
+# the session can't be used anymore and the request didn't run
+HELPER_MARKER = "__KITSU_HELPER__"
+# Evaluates one JSON encoded request per line, so Rails boots only once. The DB connection
+# is checked first, since tools --restore/--snapshot terminate it: verify! reconnects
+RAILS_REPL = (
+    'STDOUT.sync = true; '
+    'while (line = STDIN.gets); '
+    'begin; ActiveRecord::Base.connection.verify!; '
+    f'rescue Exception => e; puts e.full_message(highlight: false); puts "{HELPER_MARKER} dead"; next; end; '
+    f'begin; eval(JSON.parse(line)); puts "{HELPER_MARKER} ok"; '
+    f'rescue Exception => e; puts e.full_message(highlight: false); puts "{HELPER_MARKER} error"; end; '
+    'end'
+)
+
 def parse_args() -> None:
+    global CACHE_DIR, PARALLEL_RESTORE
     parser: argparse.ArgumentParser = argparse.ArgumentParser(
         description="Helper script to build Kitsu!"
     )
@@ -25,20 +85,34 @@ def parse_args() -> None:
     setup_parser.add_argument('--path', '-p', type=check_valid_folder, help="The path where the dev env will be set-up", required=True)
     setup_parser.add_argument('--seed', '-s', action="store_true", help="If the Database should be seeded")
     setup_parser.add_argument('--use-react', '-rc', action="store_true", help="If the react branch should be installed instead")
+    setup_parser.add_argument('--no-cache', action="store_true", help="Don't use the local cache of repositories and DB dumps")
+    setup_parser.add_argument('--parallel-restore', action="store_true", help="Keep a directory format copy of the DB dump in the cache, so the next seeds are restored with parallel jobs")
     
     tools_parser = subparser.add_parser("tools", help="Useful commands that may become handy in any moment! Must already have a dev env before using any of the tools.")
     # Give admin privileges to the user
     tools_parser.add_argument('--dev-path', '-dp', type=str, help="The path where the dev env is located.", required=True)
     tools_parser.add_argument("--gain-super-admin", "-a",
         type=str.lower,
-        nargs='?', 
-        help="Gain the PRIVILEGES! (Or: Set the given user permissions to those of super-admin); Provide the SLUG of your user with no quotes"
+        nargs='+', 
+        help="Gain the PRIVILEGES! (Or: Set the given users permissions to those of super-admin); Provide the SLUGs of your users with no quotes"
     )
-    tools_parser.add_argument("--add-flag", '-ff', type=str, help="Enable a flag from Flipper.")
+    tools_parser.add_argument("--add-flag", '-ff', type=str, nargs='+', help="Enable one or more flags from Flipper.")
     tools_parser.add_argument("--seed", '-s', action="store_true", help="Seed the database.")
-    tools_parser.add_argument("--create-user", '-c', type=str, help="Create a user account with 'test' as password. Use only for if registrations don't work.")
+    tools_parser.add_argument("--create-user", '-c', type=str, nargs='+', help="Create one or more user accounts with 'test' as password. Use only for if registrations don't work.")
+    tools_parser.add_argument('--no-cache', action="store_true", help="Don't use the local cache of DB dumps")
+    tools_parser.add_argument('--parallel-restore', action="store_true", help="Keep a directory format copy of the DB dump in the cache, so the next seeds are restored with parallel jobs")
+    tools_parser.add_argument('--snapshot', type=snapshot_name, nargs='?', const="default", help="Save the database as a snapshot with the given name (default: 'default'), to restore it later in seconds.")
+    tools_parser.add_argument('--restore', type=snapshot_name, nargs='?', const="default", help="Replace the database with a snapshot saved with --snapshot. The search index isn't part of the snapshot.")
+    tools_parser.add_argument('--start-helper', type=int, nargs='?', const=HELPER_IDLE_TIMEOUT, metavar="IDLE_TIMEOUT", help="Start a helper keeping a psql session and Rails warm, so the next tools run in milliseconds. It stops after IDLE_TIMEOUT seconds without requests (default: 30 minutes).")
+    tools_parser.add_argument('--stop-helper', action="store_true", help="Stop the helper started with --start-helper.")
+    tools_parser.add_argument('--dump', type=str, help="Seed from this dump instead of the latest one. Custom and directory format (pg_dump -Fc/-Fd) dumps are restored with parallel jobs")
+
 
 
+    # Started by tools --start-helper
+    helper_parser = subparser.add_parser("helper", help="Run the warm helper in the foreground, see tools --start-helper")
+    helper_parser.add_argument('--dev-path', '-dp', type=str, help="The path where the dev env is located.", required=True)
+    helper_parser.add_argument('--idle-timeout', type=int, default=HELPER_IDLE_TIMEOUT, help="Stop after this many seconds without requests.")
 
     args = parser.parse_args()
 
@@ -47,6 +121,10 @@ def parse_args() -> None:
         parser.print_help()
         return
 
+    if getattr(args, "no_cache", False):
+        CACHE_DIR = None
+    PARALLEL_RESTORE = getattr(args, "parallel_restore", False)
+
     # Call the setup function
     if hasattr(args, "path"):
         if args.path is not None:
@@ -54,19 +132,49 @@ def parse_args() -> None:
             setup(args.path, args.seed, use_react)
             return
     
+    if hasattr(args, "idle_timeout"):
+        run_helper(args.dev_path, args.idle_timeout)
+        return
+
     # Tools
+    try:
+        run_tools(args)
+    except CommandFailed as e:
+        sys.exit(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.RED}{e}{Style.RESET_ALL}")
+
+
+def run_tools(args: argparse.Namespace) -> None:
+    if hasattr(args, 'stop_helper'):
+        if args.stop_helper:
+            stop_helper(args.dev_path)
+    if hasattr(args, 'start_helper'):
+        if args.start_helper is not None:
+            start_helper(args.dev_path, args.start_helper)
+    # The snapshot is restored before running the other tools, and saved after them
+    if hasattr(args, 'restore'):
+        if args.restore is not None:
+            restore_snapshot(args.restore, args.dev_path)
+    # How long each batch took, and how long it would have taken without batching
+    batches = []
     if hasattr(args, 'gain_super_admin'):
         if args.gain_super_admin is not None:
-            gain_admin_powers(args.gain_super_admin, args.dev_path)
+            batches.append(gain_admin_powers(args.gain_super_admin, args.dev_path))
     if hasattr(args, 'add_flag'):
         if args.add_flag is not None:
-            enable_flipper_flag(args.add_flag, args.dev_path)
+            batches.append(enable_flipper_flags(args.add_flag, args.dev_path))
     if hasattr(args, 'create_user'):
         if args.create_user is not None:
-            create_account(args.create_user, args.dev_path)
+            batches.append(create_accounts(args.create_user))
+    if batches:
+        took = sum(batch[0] for batch in batches)
+        saved = sum(batch[1] for batch in batches) - took
+        print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Tools took {took:.1f}s, about {Fore.CYAN}{max(saved, 0):.1f}s{Fore.GREEN} saved by batching.{Style.RESET_ALL}")
     if hasattr(args, 'seed'):
         if args.seed is True:
-            seed_database(args.dev_path)
+            seed_database(args.dev_path, args.dump)
+    if hasattr(args, 'snapshot'):
+        if args.snapshot is not None:
+            snapshot_database(args.snapshot, args.dev_path)
 
 
 def check_valid_folder(dir: str) -> Optional[str]:
@@ -74,36 +182,425 @@ def check_valid_folder(dir: str) -> Optional[str]:
     if not os.path.isdir(dir):
         sys.exit(f'The provided directory does not exist: \'{dir}\'')
     
-    # Then if it's empty
-    if os.listdir(dir):
-        sys.exit(f'The directory is not empty: \'{dir}\'')
+    # Then if it's empty, or if it holds a previous setup that can be resumed
+    if os.listdir(dir) and not os.path.exists(os.path.join(dir, SETUP_STATE)):
+        sys.exit(f'The directory is not empty and has no previous setup: \'{dir}\'')
     
     # Finally return back the path
     return dir
 
 
-def gain_admin_powers(user: str, dev_env: str) -> None:
-    # Define the query
-    query = f"UPDATE users SET permissions=7, title='Staff' WHERE slug='{user}';"
-    
-    command = f""
+class CommandFailed(Exception):
+    pass
+
+
+class TaskCancelled(CommandFailed):
+    pass
+
+
+class SetupTask:
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[], Any],
+        deps: Optional[List[str]] = None,
+        fingerprint: Optional[Callable[[], Optional[str]]] = None
+    ) -> None:
+        self.name = name
+        self.func = func
+        self.deps = deps or []
+        # Returns what the task output depends on, or None if it can't tell. Tasks
+        # without one always run
+        self.fingerprint = fingerprint
+        self.key: Optional[str] = None
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.status = "pending"
+        self.log: Optional[IO] = None
+        self.log_path: Optional[str] = None
+        self.processes: List[subprocess.Popen] = []
+
+    def terminate(self) -> None:
+        for process in self.processes:
+            if process.poll() is None:
+                process.terminate()
+
+
+# The setup task running in the current thread, if any
+current_task = threading.local()
+# Set when a setup task fails, the long running steps check it to stop early
+setup_cancelled = threading.Event()
+TASK_COMPLETE = ("done", "up to date")
+
+
+class Timeline:
+    # Every step and command of a run, written as a JSON timeline and as a Chrome trace
+    # (chrome://tracing or https://ui.perfetto.dev) to see what the time goes into
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.started = time.perf_counter()
+        self.wall_started = time.time()
+        self.events: List[dict] = []
+        self.lock = threading.Lock()
+
+    def record(self, name: str, category: str, started: float, finished: float, args: dict) -> None:
+        task: Optional[SetupTask] = getattr(current_task, "task", None)
+        with self.lock:
+            self.events.append({
+                "name": name,
+                "category": category,
+                "task": task.name if task else None,
+                "start": round(started - self.started, 6),
+                "duration": round(finished - started, 6),
+                **args
+            })
+
+    def write(self, folder: str) -> str:
+        # Timestamped, so the runs can be compared over time. Returns the timeline path
+        os.makedirs(folder, exist_ok=True)
+        prefix = os.path.join(folder, f"{self.name}-{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.wall_started))}")
+        events = sorted(self.events, key=lambda event: event["start"])
+        with open(f"{prefix}.json", "w") as f:
+            json.dump({
+                "name": self.name,
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(self.wall_started)),
+                "duration": round(time.perf_counter() - self.started, 6),
+                "events": events
+            }, f, indent=2)
+
+        # One row per task in the trace, commands show up under the task that ran them
+        rows = {None: 0}
+        trace = []
+        for event in events:
+            row = rows.setdefault(event["task"], len(rows))
+            trace.append({
+                "name": event["name"],
+                "cat": event["category"],
+                "ph": "X",
+                "ts": int(event["start"] * 1e6),
+                "dur": int(event["duration"] * 1e6),
+                "pid": 1,
+                "tid": row,
+                "args": {key: value for key, value in event.items() if key not in ("name", "category", "start", "duration")}
+            })
+        trace += [{"name": "thread_name", "ph": "M", "pid": 1, "tid": row, "args": {"name": task or self.name}} for task, row in rows.items()]
+        with open(f"{prefix}.trace.json", "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+        return f"{prefix}.json"
+
+
+# The timeline of the current run, None when not recording
+timeline: Optional[Timeline] = None
+
+
+@contextmanager
+def timed(name: str, category: str = "step") -> Iterator[dict]:
+    # Record the block in the timeline. Values added to the yielded dict, like bytes
+    # or rows, are saved with the event
+    args: dict = {}
+    started = time.perf_counter()
+    try:
+        yield args
+        args.setdefault("status", "ok")
+    except BaseException as e:
+        args["status"] = "failed"
+        args["error"] = str(e)
+        raise
+    finally:
+        if timeline is not None:
+            timeline.record(name, category, started, time.perf_counter(), args)
+
+
+@contextmanager
+def recording(name: str, dev_env: str) -> Iterator[None]:
+    # Record a timeline for the block, unless one is already being recorded,
+    # and write it to .kitsu-builder/timelines in the dev env folder
+    global timeline
+    if timeline is not None:
+        yield
+        return
+    timeline = Timeline(name)
+    try:
+        yield
+    finally:
+        path = timeline.write(os.path.join(dev_env, ".kitsu-builder", "timelines"))
+        timeline = None
+        print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Timeline saved to {Fore.CYAN}{path}{Fore.GREEN} (Chrome trace: {path.removesuffix('.json')}.trace.json).{Style.RESET_ALL}")
+
+
+def check_cancelled() -> None:
+    if setup_cancelled.is_set():
+        raise TaskCancelled("cancelled because another task failed")
+
+
+def run_command(command: list, cwd: Optional[str] = None) -> None:
+    # Run a command, raising CommandFailed if it doesn't succeed. Inside a setup task
+    # the output goes to the task log, so parallel tasks don't mix their output
+    check_cancelled()
+    task: Optional[SetupTask] = getattr(current_task, "task", None)
+    with timed(" ".join([os.path.basename(command[0]), *command[1:]])[:120], "command") as event:
+        if task is None:
+            process = subprocess.Popen(command, cwd=cwd)
+        else:
+            process = subprocess.Popen(command, cwd=cwd, stdin=subprocess.DEVNULL, stdout=task.log, stderr=subprocess.STDOUT)
+            task.processes.append(process)
+        code = process.wait()
+        event["exit_code"] = code
+        if code != 0:
+            raise CommandFailed(f"'{' '.join(command)}' exited with code {code}")
+
+
+def file_hash(path: str) -> Optional[str]:
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def git_head(path: str) -> Optional[str]:
+    if not os.path.isdir(os.path.join(path, ".git")):
+        return None
+    head = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=path, capture_output=True, text=True)
+    return head.stdout.strip() if head.returncode == 0 else None
+
+
+def task_key(task: SetupTask, tasks: Dict[str, SetupTask]) -> tuple:
+    # Like a build system, the key covers the task inputs and the keys of its
+    # dependencies, so a change anywhere upstream makes the task stale. Also
+    # returns if the task can be skipped at all
+    fingerprint = task.fingerprint() if task.fingerprint else None
+    deps = [tasks[dep].key for dep in task.deps]
+    return hashlib.sha1(json.dumps([fingerprint, deps]).encode()).hexdigest(), fingerprint is not None
+
+
+def run_task(task: SetupTask, tasks: Dict[str, SetupTask], results: dict, state: dict) -> bool:
+    # Returns False if the task was up to date and didn't run
+    current_task.task = task
+    try:
+        with timed(task.name, "task") as event:
+            key, skippable = task_key(task, tasks)
+            if skippable and state.get(task.name) == key:
+                task.key = key
+                event["status"] = "up to date"
+                return False
+            with open(task.log_path, "w") as task.log:
+                results[task.name] = task.func()
+            # The fingerprint is taken again, since the task may have changed its own inputs
+            task.key, _ = task_key(task, tasks)
+            return True
+    finally:
+        current_task.task = None
+
+
+def load_setup_state(path: str) -> dict:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_setup_state(path: str, state: dict) -> None:
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def critical_path(tasks: Dict[str, SetupTask]) -> List[SetupTask]:
+    # Walk back from the last task to finish, always following the dependency that finished last
+    task = max(tasks.values(), key=lambda t: t.finished or 0)
+    path = [task]
+    while task.deps:
+        task = max((tasks[dep] for dep in task.deps), key=lambda t: t.finished or 0)
+        path.append(task)
+    return path[::-1]
+
+
+def print_task_report(tasks: Dict[str, SetupTask], started: float) -> None:
+    print(f"\n{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Setup timings:{Style.RESET_ALL}")
+    for task in sorted(tasks.values(), key=lambda t: t.started or float("inf")):
+        if task.started is None:
+            print(f"  {task.name:<24} {Fore.LIGHTBLACK_EX}not started{Style.RESET_ALL}")
+            continue
+        color = Fore.GREEN if task.status in TASK_COMPLETE else Fore.RED
+        print(f"  {task.name:<24} +{task.started - started:7.1f}s  {(task.finished or time.perf_counter()) - task.started:7.1f}s  {color}{task.status}{Style.RESET_ALL}")
+    if all(task.status in TASK_COMPLETE for task in tasks.values()):
+        path = critical_path(tasks)
+        print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Critical path: {Fore.CYAN}{' -> '.join(task.name for task in path)}{Style.RESET_ALL}")
+
+
+def run_tasks(tasks: List[SetupTask], log_dir: str, results: dict, state_path: Optional[str] = None) -> None:
+    # Run every task as soon as all of its dependencies are done. If one fails
+    # the others are stopped, and the failing task output is shown. Tasks whose
+    # fingerprint matches the one saved in state_path by the last run are skipped
+    by_name = {task.name: task for task in tasks}
+    for task in tasks:
+        for dep in task.deps:
+            if dep not in by_name:
+                raise ValueError(f"Task {task.name} depends on unknown task {dep}")
+    os.makedirs(log_dir, exist_ok=True)
+    state = {}
+    if state_path:
+        # Saved right away, so the folder is known as a setup folder even if the first task fails
+        state = load_setup_state(state_path)
+        save_setup_state(state_path, state)
+
+    # Tasks run in daemon threads, so a failure can be reported and the script can exit
+    # without waiting for the other tasks to notice they were cancelled
+    finished: queue.Queue = queue.Queue()
+
+    def run(task: SetupTask) -> None:
+        try:
+            finished.put((task, run_task(task, by_name, results, state), None))
+        except BaseException as e:
+            finished.put((task, False, e))
+
+    setup_cancelled.clear()
+    started = time.perf_counter()
+    running = 0
+    while any(task.status == "pending" for task in tasks) or running:
+        for task in tasks:
+            if task.status == "pending" and all(by_name[dep].status in TASK_COMPLETE for dep in task.deps):
+                task.status = "running"
+                task.started = time.perf_counter()
+                task.log_path = os.path.join(log_dir, f"{task.name.replace(' ', '-')}.log")
+                threading.Thread(target=run, args=(task,), name=task.name, daemon=True).start()
+                running += 1
+        if not running:
+            break
+
+        task, ran, error = finished.get()
+        running -= 1
+        task.finished = time.perf_counter()
+        if error is None:
+            task.status = "done" if ran else "up to date"
+            if state_path:
+                # Saved after every task, so a failed run can be resumed
+                state[task.name] = task.key
+                save_setup_state(state_path, state)
+            continue
+
+        task.status = "failed"
+        if state_path and state.pop(task.name, None) is not None:
+            save_setup_state(state_path, state)
+        # Stop the other tasks: their commands are killed, and the downloads and
+        # readiness polls stop at their next check
+        setup_cancelled.set()
+        for other in tasks:
+            if other.status == "running":
+                other.status = "cancelled"
+                other.terminate()
+        print_task_report(by_name, started)
+        with open(task.log_path) as f:
+            output = f.read()[-5000:]
+        print(f"\n{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.RED}Task {Fore.CYAN}{task.name}{Fore.RED} failed: {error}{Style.RESET_ALL}")
+        print(output)
+        sys.exit(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.RED}Setup failed, full log: {task.log_path}{Style.RESET_ALL}")
+    print_task_report(by_name, started)
+
+
+def postgres_ready(dev_env: str) -> bool:
+    check = subprocess.run(
+        ["docker", "compose", "exec", "-T", "postgres", "pg_isready", "--host=postgres", "--username=kitsu_development", "--dbname=kitsu_development"],
+        cwd=dev_env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return check.returncode == 0
+
+
+def http_ready(url: str) -> bool:
+    # Anything but a server error means the service is up
+    import requests
+    try:
+        return requests.get(url, timeout=5).status_code < 500
+    except requests.RequestException:
+        return False
+
+
+def api_ready() -> bool:
+    return http_ready(f"{KITSU_API}/anime?page[limit]=1")
+
+
+def running_services(dev_env: str) -> List[str]:
+    services = subprocess.run(["docker", "compose", "ps", "--status", "running", "--services"], cwd=dev_env, stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    return services.stdout.split()
+
+
+def check_running(dev_env: str, services: List[str]) -> None:
+    # Waiting for a stopped container would only time out, so tools fail right away
+    running = running_services(dev_env)
+    stopped = [service for service in services if service not in running]
+    if stopped:
+        raise CommandFailed(f"{', '.join(stopped)} {'is' if len(stopped) == 1 else 'are'} not running, start the dev env with bin/start first")
+
+
+def typesense_ready(dev_env: str) -> bool:
+    # typesense is checked through its published port, if there's one
+    port = subprocess.run(["docker", "compose", "port", "typesense", str(TYPESENSE_PORT)], cwd=dev_env, stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    if port.returncode == 0 and port.stdout.strip():
+        return http_ready(f"http://127.0.0.1:{port.stdout.strip().rsplit(':', 1)[1]}/health")
+    # Otherwise the best we can do is checking that the container is running
+    return "typesense" in running_services(dev_env)
+
+
+def poll_ready(name: str, check: Callable[[], bool], deadline: float) -> None:
+    # Retry the check with exponential backoff until it passes or the deadline is reached
+    started = time.perf_counter()
+    delay = READY_MIN_DELAY
+    while not check():
+        if time.perf_counter() + delay > deadline:
+            raise CommandFailed(f"{name} was not ready after {time.perf_counter() - started:.0f}s")
+        if setup_cancelled.wait(delay):
+            check_cancelled()
+        delay = min(delay * 2, READY_MAX_DELAY)
+    print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}{name} is ready ({time.perf_counter() - started:.1f}s).{Style.RESET_ALL}")
+
+
+def wait_ready(checks: Dict[str, Callable[[], bool]], timeout: float = READY_TIMEOUT) -> None:
+    # Poll every service at the same time, so the total wait is the one of the slowest
+    deadline = time.perf_counter() + timeout
+    with ThreadPoolExecutor(max_workers=len(checks)) as executor:
+        for future in [executor.submit(poll_ready, name, check, deadline) for name, check in checks.items()]:
+            future.result()
+
+
+def sql_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def gain_admin_powers(users: List[str], dev_env: str) -> tuple:
+    # Every user is updated by the same query, in a single psql session.
+    # Returns how long it took and how long one session per user would have taken
+    started = time.perf_counter()
+    query = f"UPDATE users SET permissions=7, title='Staff' WHERE slug IN ({', '.join(sql_literal(user) for user in users)});"
     psql = ["docker", "compose", "exec", "-T", "-i", "postgres", "psql", "--username=kitsu_development", "--host=postgres", "-d", "kitsu_development", "--command", query]
     
-    # Run the command in the docker container
-    
-    docker_comp = subprocess.Popen(psql, cwd=dev_env)
-    docker_comp.wait()
+    # Run the command in the docker container, or through the helper if it's running
+    if not run_through_helper(dev_env, "sql", query):
+        run_command(psql, cwd=dev_env)
+    took = time.perf_counter() - started
 
-    print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Command executed. If you see {Fore.CYAN}\"UPDATE 1\"{Fore.GREEN}, you now have the POWERS!{Style.RESET_ALL}")
+    print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Command executed. If you see {Fore.CYAN}\"UPDATE {len(users)}\"{Fore.GREEN}, you now have the POWERS!{Style.RESET_ALL}")
+    return took, took * len(users)
 
 
-def enable_flipper_flag(flag: str, dev_env: str) -> None:
-    print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Enabling {flag} flag!{Style.RESET_ALL}")
-    rails_console = subprocess.Popen(['bin/rails', 'runner', f'Flipper[:{flag}].enable'], cwd=dev_env)
-    rails_console.wait()
+def enable_flipper_flags(flags: List[str], dev_env: str) -> tuple:
+    # Rails takes a while to boot, so every flag is enabled by the same runner.
+    # Returns how long it took and how long one runner per flag would have taken
+    for flag in flags:
+        if not re.fullmatch(r"[\w.:-]+", flag):
+            raise CommandFailed(f"invalid flag name '{flag}'")
+    print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Enabling {', '.join(flags)} flag{'s' if len(flags) > 1 else ''}!{Style.RESET_ALL}")
+    started = time.perf_counter()
+    script = f'{json.dumps(flags)}.each {{ |flag| Flipper[flag].enable }}'
+    if not run_through_helper(dev_env, "ruby", script):
+        run_command(['bin/rails', 'runner', script], cwd=dev_env)
+    took = time.perf_counter() - started
+    return took, took * len(flags)
 
 
-def create_account(username: str, dev_env: str) -> None:
+def create_account(session: "requests.Session", username: str) -> Optional[str]:
+    # Returns the error, if any
+    import requests
     headers = {"Content-Type":"application/vnd.api+json"}
     payload = {
     "data": {
@@ -116,99 +613,849 @@ def create_account(username: str, dev_env: str) -> None:
         "type": "users"
         }
     }
-    req = requests.post("http://kitsu.localhost:42069/api/edge/users", json=payload, headers=headers)
-    print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Created user \"{username}\"!{Style.RESET_ALL}")
+    try:
+        req = session.post(f"{KITSU_API}/users", json=payload, headers=headers, timeout=60)
+    except requests.RequestException as e:
+        return str(e)
+    if not req.ok:
+        return f"HTTP {req.status_code}: {req.text[:200]}"
+    return None
 
 
-def seed_database(dev_env: str) -> None:
-    KITSU_DB_DUMP = "https://f002.backblazeb2.com/file/kitsu-dumps/latest.sql.gz"
-    
+def create_accounts(usernames: List[str]) -> tuple:
+    # The accounts are created concurrently, over keep-alive connections.
+    # Returns how long it took and how long creating them one by one took
+    import requests
+    started = time.perf_counter()
+    wait_ready({"API": api_ready}, TOOLS_READY_TIMEOUT)
+    latencies = []
+
+    def create(username: str) -> Optional[str]:
+        request_started = time.perf_counter()
+        error = create_account(session, username)
+        latencies.append(time.perf_counter() - request_started)
+        return error
+
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=min(len(usernames), ACCOUNT_WORKERS)) as executor:
+        session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=ACCOUNT_WORKERS))
+        for username, error in zip(usernames, executor.map(create, usernames)):
+            if error is None:
+                print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Created user \"{username}\"!{Style.RESET_ALL}")
+            else:
+                print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.RED}Could not create user \"{username}\": {error}{Style.RESET_ALL}")
+    return time.perf_counter() - started, sum(latencies)
+
+
+def snapshot_name(name: str) -> str:
+    # Snapshots are databases next to kitsu_development, so the name must be a valid identifier
+    if not re.fullmatch(r"[a-z0-9_]{1,40}", name):
+        raise argparse.ArgumentTypeError(f"invalid snapshot name '{name}', use lowercase letters, digits and _")
+    return name
+
+
+def run_maintenance_queries(queries: List[str], dev_env: str) -> None:
+    # Every query is sent as its own --command, since CREATE/DROP DATABASE can't run inside
+    # a transaction. The connection goes to the postgres DB, so kitsu_development can be replaced
+    psql = ["docker", "compose", "exec", "-T", "postgres", "psql", "--username=kitsu_development", "--host=postgres", "-d", "postgres", "-v", "ON_ERROR_STOP=1"]
+    for query in queries:
+        psql += ["--command", query]
+    run_command(psql, cwd=dev_env)
+
+
+def disconnect_queries(database: str) -> List[str]:
+    # A database can't be copied or dropped while someone is connected to it, so the server
+    # and sidekiq connections are closed and new ones refused until it's done
+    return [
+        f"ALTER DATABASE {database} WITH ALLOW_CONNECTIONS false;",
+        f"SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname = '{database}' AND pid <> pg_backend_pid();",
+    ]
+
+
+def snapshot_database(name: str, dev_env: str) -> None:
+    # Save kitsu_development as a template database, which is a file level copy
+    snapshot = f"{SNAPSHOT_PREFIX}{name}"
+    started = time.perf_counter()
+    print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.CYAN}Saving the database as snapshot {name}..{Style.RESET_ALL}")
+    try:
+        run_maintenance_queries([
+            *disconnect_queries("kitsu_development"),
+            f"DROP DATABASE IF EXISTS {snapshot};",
+            f"CREATE DATABASE {snapshot} TEMPLATE kitsu_development;",
+            # Nobody should connect to the snapshot, or it couldn't be used as a template
+            f"ALTER DATABASE {snapshot} WITH ALLOW_CONNECTIONS false;",
+        ], dev_env)
+    finally:
+        run_maintenance_queries(["ALTER DATABASE kitsu_development WITH ALLOW_CONNECTIONS true;"], dev_env)
+    print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Snapshot {Fore.CYAN}{name}{Fore.GREEN} saved in {time.perf_counter() - started:.1f}s.{Style.RESET_ALL}")
+
+
+def restore_snapshot(name: str, dev_env: str) -> None:
+    # Replace kitsu_development with a copy of the snapshot
+    snapshot = f"{SNAPSHOT_PREFIX}{name}"
+    started = time.perf_counter()
+    print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.CYAN}Restoring snapshot {name}..{Style.RESET_ALL}")
+    # The snapshot is checked first, so the database isn't dropped for nothing
+    check = subprocess.run(
+        ["docker", "compose", "exec", "-T", "postgres", "psql", "--username=kitsu_development", "--host=postgres", "-d", "postgres", "-tA",
+         "--command", f"SELECT 1 FROM pg_database WHERE datname = '{snapshot}';"],
+        cwd=dev_env, capture_output=True, text=True
+    )
+    if check.returncode != 0:
+        raise CommandFailed(f"could not reach the database: {check.stderr.strip()}")
+    if check.stdout.strip() != "1":
+        raise CommandFailed(f"there is no snapshot named '{name}'")
+
+    try:
+        run_maintenance_queries([
+            *disconnect_queries("kitsu_development"),
+            "DROP DATABASE kitsu_development;",
+            f"CREATE DATABASE kitsu_development TEMPLATE {snapshot};",
+        ], dev_env)
+    except CommandFailed as e:
+        raise CommandFailed(f"could not restore snapshot '{name}', see the psql error above") from e
+    finally:
+        # If the DB couldn't be dropped it must accept connections again. A new one already does,
+        # and if it's gone there's nothing to change
+        run_maintenance_queries([
+            "DO $$ BEGIN "
+            "IF EXISTS (SELECT 1 FROM pg_database WHERE datname = 'kitsu_development') THEN "
+            "ALTER DATABASE kitsu_development WITH ALLOW_CONNECTIONS true; "
+            "END IF; END $$;"
+        ], dev_env)
+    print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Snapshot {Fore.CYAN}{name}{Fore.GREEN} restored in {time.perf_counter() - started:.1f}s.{Style.RESET_ALL}")
+
+
+class WarmSession:
+    # A psql or rails runner process kept running by the helper, which reads
+    # requests from stdin and prints HELPER_MARKER when each one is done
+    def __init__(self, command: list, cwd: str) -> None:
+        self.process = subprocess.Popen(command, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1)
+
+    def run(self, request: str) -> tuple:
+        self.process.stdin.write(request)
+        self.process.stdin.flush()
+        output = []
+        for line in self.process.stdout:
+            if line.startswith(HELPER_MARKER):
+                if line.split()[1] == "dead":
+                    raise CommandFailed(f"the session lost its DB connection: {''.join(output[-5:])}")
+                return line.split()[1] == "ok" and not any("ERROR:" in out for out in output), "".join(output)
+            output.append(line)
+        raise CommandFailed(f"'{' '.join(self.process.args)}' exited with code {self.process.wait()}: {''.join(output[-20:])}")
+
+    def close(self) -> None:
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.terminate()
+
+
+def run_helper(dev_env: str, idle_timeout: int) -> None:
+    # Serve SQL and Ruby requests through warm sessions, one request per connection.
+    # The sessions are started by the first request that needs them
+    dev_env = os.path.abspath(dev_env)
+    path = os.path.join(dev_env, HELPER_SOCKET)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.remove(path)
+    sessions: Dict[str, WarmSession] = {}
+    session_commands = {
+        # Not quiet, so the command tags (UPDATE N) are shown like without the helper
+        "sql": [*PSQL_COMMAND, "--no-psqlrc"],
+        "ruby": ["bin/rails", "runner", RAILS_REPL],
+    }
+
+    def run_in_session(kind: str, request: str) -> tuple:
+        # A session can die between requests (container restart) or during one (psql
+        # exits when tools --restore/--snapshot terminate its connection, Rails reports
+        # it couldn't reconnect). The request never ran then, so it's sent once more to a new session
+        for attempt in range(2):
+            if kind not in sessions:
+                sessions[kind] = WarmSession(session_commands[kind], dev_env)
+            try:
+                return sessions[kind].run(request)
+            except (CommandFailed, OSError) as e:
+                sessions.pop(kind).close()
+                if attempt:
+                    return False, str(e)
+                print(f"{kind} session died ({e}), starting a new one", flush=True)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+    server.settimeout(idle_timeout)
+    print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Helper listening on {path}, stopping after {idle_timeout}s without requests.{Style.RESET_ALL}", flush=True)
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Helper idle, stopping.{Style.RESET_ALL}", flush=True)
+                return
+            with conn, conn.makefile("rw") as stream:
+                request = json.loads(stream.readline() or "{}")
+                kind = request.get("kind")
+                if kind == "stop":
+                    stream.write(json.dumps({"ok": True, "output": ""}) + "\n")
+                    return
+                started = time.perf_counter()
+                if kind == "ping":
+                    ok, output = True, ""
+                elif kind == "sql":
+                    ok, output = run_in_session("sql", f"{request['code']}\n\\echo {HELPER_MARKER} ok\n")
+                elif kind == "ruby":
+                    ok, output = run_in_session("ruby", json.dumps(request["code"]) + "\n")
+                else:
+                    ok, output = False, f"unknown request {kind}"
+                print(f"{kind} request {'done' if ok else 'failed'} in {time.perf_counter() - started:.3f}s", flush=True)
+                stream.write(json.dumps({"ok": ok, "output": output}) + "\n")
+    finally:
+        server.close()
+        os.remove(path)
+        for session in sessions.values():
+            session.close()
+
+
+def helper_request(dev_env: str, kind: str, code: str = "") -> Optional[dict]:
+    # Send a request to the helper, None if it isn't running
+    path = os.path.join(os.path.abspath(dev_env), HELPER_SOCKET)
+    if not os.path.exists(path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.connect(path)
+            with conn.makefile("rw") as stream:
+                stream.write(json.dumps({"kind": kind, "code": code}) + "\n")
+                stream.flush()
+                return json.loads(stream.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def start_helper(dev_env: str, idle_timeout: int) -> None:
+    if helper_request(dev_env, "ping") is not None:
+        print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}The helper is already running.{Style.RESET_ALL}")
+        return
+    log = os.path.join(os.path.abspath(dev_env), ".kitsu-builder", "helper.log")
+    os.makedirs(os.path.dirname(log), exist_ok=True)
+    # Started in its own session, so it keeps running after this invocation exits
+    with open(log, "a") as f:
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "helper", "--dev-path", dev_env, "--idle-timeout", str(idle_timeout)],
+            stdin=subprocess.DEVNULL, stdout=f, stderr=subprocess.STDOUT, start_new_session=True
+        )
+    # Wait for the socket, so the next tools can already use it
+    for _ in range(50):
+        if helper_request(dev_env, "ping") is not None:
+            print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Helper started, it stops after {idle_timeout}s without requests (log: {log}).{Style.RESET_ALL}")
+            return
+        time.sleep(0.1)
+    raise CommandFailed(f"the helper didn't start, see {log}")
+
+
+def stop_helper(dev_env: str) -> None:
+    if helper_request(dev_env, "stop") is None:
+        print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}The helper isn't running.{Style.RESET_ALL}")
+    else:
+        print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Helper stopped.{Style.RESET_ALL}")
+
+
+def run_through_helper(dev_env: str, kind: str, code: str) -> bool:
+    # Returns False if the helper isn't running, so the caller runs the command itself
+    response = helper_request(dev_env, kind, code)
+    if response is None:
+        return False
+    print(response["output"], end="")
+    if not response["ok"]:
+        raise CommandFailed(f"the helper could not run the {kind} request")
+    return True
+
+
+# psql command used to import into the kitsu_development DB of the dev env.
+# The -T parameter disable TTY, see https://docs.docker.com/engine/reference/commandline/compose_exec/
+PSQL_COMMAND = ["docker", "compose", "exec", "-T", "-i", "postgres", "psql", "--username=kitsu_development", "--host=postgres", "kitsu_development"]
+# Size of the chunks read from the dump download
+DUMP_CHUNK_SIZE = 1024 * 1024
+# The dump is downloaded in this many parallel ranges
+DOWNLOAD_PARTS = 8
+# Each range starts reading DOWNLOAD_MIN_CHUNK bytes at a time, and grows up to DOWNLOAD_MAX_CHUNK
+DOWNLOAD_MIN_CHUNK = 256 * 1024
+DOWNLOAD_MAX_CHUNK = 8 * 1024 * 1024
+# Seconds to connect, and to wait for the next bytes of a range before giving up on it
+DOWNLOAD_TIMEOUT = (30, 60)
+# Custom and directory format dumps are restored with pg_restore using this many jobs
+RESTORE_JOBS = os.cpu_count() or 4
+# Where dumps are copied inside the postgres container
+CONTAINER_DUMP_PATH = "/tmp/kitsu-restore"
+# pg_restore/pg_dump connection arguments, used through docker compose exec
+PG_ARGS = ["--username=kitsu_development", "--host=postgres", "--dbname=kitsu_development"]
+# Plain dumps are converted to directory format and cached, so the next seed can be a parallel restore
+PARALLEL_RESTORE = False
+
+
+def count_dump_rows(data: bytes, state: dict) -> int:
+    # Counts the rows inside the COPY ... FROM stdin; blocks of a plain SQL dump.
+    # data must be made of whole lines, state keeps track of whether
+    # we're inside a COPY block between calls
+    rows = 0
+    pos = 0
+    while pos < len(data):
+        if state["in_copy"]:
+            # A COPY block ends with a line containing only "\."
+            end = find_line(data, b"\\.\n", pos)
+            if end == -1:
+                return rows + data.count(b"\n", pos)
+            rows += data.count(b"\n", pos, end)
+            state["in_copy"] = False
+            pos = end + 3
+        else:
+            start = find_line(data, b"COPY ", pos)
+            if start == -1:
+                return rows
+            pos = data.find(b"\n", start) + 1
+            state["in_copy"] = True
+    return rows
+
+
+def find_line(data: bytes, prefix: bytes, pos: int) -> int:
+    # Position of the first line starting with prefix, pos must be at the start of a line
+    if data.startswith(prefix, pos):
+        return pos
+    found = data.find(b"\n" + prefix, pos)
+    return found if found == -1 else found + 1
+
+
+def import_dump(chunks: Iterable[bytes], total: Optional[int], command: list, cwd: str, compressed: bool = True) -> tuple:
+    # Pipe the gzipped dump chunks into psql while they're being decompressed,
+    # so the plain SQL is never written to disk. Returns the read bytes and imported rows
+    from tqdm import tqdm
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if compressed else None  # 16 + MAX_WBITS = gzip header
+    copy_state = {"in_copy": False}
+    read = rows = 0
+    leftover = b""
+
+    task: Optional[SetupTask] = getattr(current_task, "task", None)
+    psql = subprocess.Popen(command, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=task.log if task else None, bufsize=0)
+    if task is not None:
+        task.processes.append(psql)
+    try:
+        pbar = tqdm(total=total, unit="B", unit_scale=True, unit_divisor=1024)
+        for chunk in chunks:
+            check_cancelled()
+            if not chunk:
+                continue
+            data = decompressor.decompress(chunk) if decompressor else chunk
+            psql.stdin.write(data)
+
+            # Only whole lines are scanned for rows, the rest waits for the next chunk
+            lines, newline, leftover = (leftover + data).rpartition(b"\n")
+            rows += count_dump_rows(lines + newline, copy_state)
+            read += len(chunk)
+            pbar.update(len(chunk))
+            pbar.set_postfix_str(f"{rows} rows", refresh=False)
+        # zlib checks the gzip CRC when it reaches the end of the stream, so a corrupted
+        # dump doesn't go unnoticed, but we must make sure that the end was reached
+        data = decompressor.flush() if decompressor else b""
+        if decompressor and not decompressor.eof:
+            raise zlib.error("unexpected end of the gzip stream")
+        psql.stdin.write(data)
+        rows += count_dump_rows(leftover + data, copy_state)
+        pbar.set_postfix_str(f"{rows} rows", refresh=False)
+        pbar.close()
+        psql.stdin.close()
+    except BrokenPipeError:
+        raise CommandFailed(f"psql exited with code {psql.wait()} while importing the dump")
+    except zlib.error as e:
+        raise CommandFailed(f"the DB dump is corrupted: {e}")
+    finally:
+        if not psql.stdin.closed:
+            psql.stdin.close()
+        code = psql.wait()
+    # psql may also fail after reading the whole dump
+    if code != 0:
+        raise CommandFailed(f"psql exited with code {code} while importing the dump")
+    return read, rows
+
+
+def stream_dump(url: str, command: list, cwd: str) -> tuple:
+    # Import the dump while it's being downloaded
+    import requests
+    with requests.get(url, stream=True) as r:
+        r.raise_for_status()
+        # Content-Length is only used for the progress bar, so it's fine if it's missing
+        total = r.headers.get('Content-Length')
+        return import_dump(r.iter_content(chunk_size=DUMP_CHUNK_SIZE), int(total) if total else None, command, cwd)
+
+
+def dump_format(path: str) -> str:
+    # pg_restore only reads custom and directory format dumps
+    if os.path.isdir(path):
+        if not os.path.exists(os.path.join(path, "toc.dat")):
+            raise ValueError(f"{path} is not a directory format dump")
+        return "directory"
+    with open(path, "rb") as f:
+        magic = f.read(5)
+    if magic == b"PGDMP":
+        return "custom"
+    if magic[:2] == b"\x1f\x8b":
+        return "plain-gzip"
+    return "plain"
+
+
+def run_pg_restore(args: list, cwd: str) -> dict:
+    # Run pg_restore in the postgres container, returning how long each table and index took.
+    # In verbose mode parallel restores print when every item is launched and finished
+    task: Optional[SetupTask] = getattr(current_task, "task", None)
+    command = ["docker", "compose", "exec", "-T", "postgres", "pg_restore", "--verbose", "--no-owner", "--no-privileges", *PG_ARGS, *args]
+    restore = subprocess.Popen(command, cwd=cwd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if task is not None:
+        task.processes.append(restore)
+
+    launched: Dict[str, float] = {}
+    timings: Dict[str, float] = {}
+    errors = []
+    for line in restore.stderr:
+        if task is not None:
+            task.log.write(line)
+        item = line.split(" item ", 1)
+        if "launching item" in line:
+            launched[item[1].split(" ", 1)[1].strip()] = time.perf_counter()
+        elif "finished item" in line:
+            name = item[1].split(" ", 1)[1].strip()
+            if name in launched:
+                timings[name] = time.perf_counter() - launched.pop(name)
+        elif "error:" in line and "ERROR:" in line:
+            errors.append(line.strip())
+
+    code = restore.wait()
+    # The public schema is created again by some dumps, that's the only error we can ignore
+    if code != 0 and (not errors or any("already exists" not in error for error in errors)):
+        raise CommandFailed(f"pg_restore exited with code {code}: {' / '.join(errors[-3:])}")
+    return timings
+
+
+def restore_dump(dump_path: str, cwd: str) -> None:
+    # Restore a custom/directory format dump with parallel jobs: first the schema,
+    # then the data of every table, and only then the indexes and constraints
+    phases = {}
+    started = time.perf_counter()
+    run_command(["docker", "compose", "exec", "-T", "postgres", "rm", "-rf", CONTAINER_DUMP_PATH], cwd=cwd)
+    run_command(["docker", "compose", "cp", dump_path, f"postgres:{CONTAINER_DUMP_PATH}"], cwd=cwd)
+    phases["copy"] = time.perf_counter() - started
+
+    timings: Dict[str, float] = {}
+    try:
+        for section, jobs in (("pre-data", 1), ("data", RESTORE_JOBS), ("post-data", RESTORE_JOBS)):
+            print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.CYAN}Restoring {section} with {jobs} jobs..{Style.RESET_ALL}")
+            started = time.perf_counter()
+            with timed(f"pg_restore {section}") as event:
+                section_timings = run_pg_restore([f"--section={section}", f"--jobs={jobs}", CONTAINER_DUMP_PATH], cwd)
+                event.update(jobs=jobs, items=len(section_timings))
+            timings.update(section_timings)
+            phases[section] = time.perf_counter() - started
+    finally:
+        run_command(["docker", "compose", "exec", "-T", "postgres", "rm", "-rf", CONTAINER_DUMP_PATH], cwd=cwd)
+
+    print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Restore timings: {Fore.CYAN}{', '.join(f'{name} {took:.1f}s' for name, took in phases.items())}{Style.RESET_ALL}")
+    for kind in ("TABLE DATA", "INDEX"):
+        slowest = sorted(((took, name) for name, took in timings.items() if name.startswith(f"{kind} ")), reverse=True)[:10]
+        if slowest:
+            print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Slowest {kind.lower()} items:{Style.RESET_ALL}")
+            for took, name in slowest:
+                print(f"  {name.removeprefix(f'{kind} '):<60} {took:7.1f}s")
+
+
+def convert_dump(dest: str, cwd: str) -> None:
+    # Dump the freshly imported DB in directory format with parallel jobs, so it can
+    # be restored with pg_restore next time
+    print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.CYAN}Converting the DB dump for parallel restores..{Style.RESET_ALL}")
+    run_command(["docker", "compose", "exec", "-T", "postgres", "rm", "-rf", CONTAINER_DUMP_PATH], cwd=cwd)
+    try:
+        run_command(["docker", "compose", "exec", "-T", "postgres", "pg_dump", *PG_ARGS, "--format=directory", f"--jobs={RESTORE_JOBS}", f"--file={CONTAINER_DUMP_PATH}"], cwd=cwd)
+        # Copied next to the final path first, so an interrupted copy is never used
+        if os.path.exists(f"{dest}.tmp"):
+            rmtree(f"{dest}.tmp")
+        run_command(["docker", "compose", "cp", f"postgres:{CONTAINER_DUMP_PATH}", f"{dest}.tmp"], cwd=cwd)
+        os.replace(f"{dest}.tmp", dest)
+    finally:
+        run_command(["docker", "compose", "exec", "-T", "postgres", "rm", "-rf", CONTAINER_DUMP_PATH], cwd=cwd)
+
+
+def download_part(url: str, path: str, part: list, state: dict, lock: threading.Lock, pbar: "tqdm", stop: threading.Event) -> None:
+    # part is [start, end, next byte to download], end included like in the Range header.
+    # Returns early when stop is set, what was downloaded is kept for the next run
+    import requests
+    chunk_size = DOWNLOAD_MIN_CHUNK
+    with requests.get(url, headers={"Range": f"bytes={part[2]}-{part[1]}"}, stream=True, timeout=DOWNLOAD_TIMEOUT) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise IOError(f"the server ignored the range request (HTTP {r.status_code})")
+        with open(path, "r+b") as f:
+            f.seek(part[2])
+            raw = r.raw
+            while part[2] <= part[1]:
+                check_cancelled()
+                if stop.is_set():
+                    return
+                started = time.monotonic()
+                chunk = raw.read(min(chunk_size, part[1] - part[2] + 1))
+                if not chunk:
+                    raise IOError("connection closed before the end of the range")
+                f.write(chunk)
+                with lock:
+                    part[2] += len(chunk)
+                    save_download_state(path, state)
+                pbar.update(len(chunk))
+                # Grow the chunks while they arrive quickly, so fast links don't spend their time on bookkeeping
+                if time.monotonic() - started < 0.5:
+                    chunk_size = min(chunk_size * 2, DOWNLOAD_MAX_CHUNK)
+
+
+def save_download_state(path: str, state: dict) -> None:
+    with open(f"{path}.state.tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(f"{path}.state.tmp", f"{path}.state")
+
+
+def verify_download(path: str, headers: dict) -> bool:
+    # Backblaze sends the SHA1 of the file, other servers usually have the MD5 as ETag.
+    # With neither of them, the gzip CRC is still checked while importing
+    sha1 = headers.get("x-bz-content-sha1", "")
+    etag = headers.get("ETag", "").strip('"')
+    if len(sha1) == 40:
+        expected, digest = sha1, hashlib.sha1()
+    elif len(etag) == 32 and all(c in "0123456789abcdef" for c in etag.lower()):
+        expected, digest = etag.lower(), hashlib.md5()
+    else:
+        return True
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_MAX_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest() == expected
+
+
+def download_dump(url: str, path: str, head: "requests.Response") -> Optional[int]:
+    # Download the dump with DOWNLOAD_PARTS parallel range requests, resuming from a previous
+    # interrupted download if there's one. Returns the size, or None if the server can't do ranges
+    import requests
+    import urllib3
+    from tqdm import tqdm
+    size = int(head.headers.get("Content-Length", 0))
+    if head.headers.get("Accept-Ranges") != "bytes" or not size:
+        return None
+
+    state = None
+    if os.path.exists(f"{path}.state") and os.path.exists(path):
+        with open(f"{path}.state") as f:
+            state = json.load(f)
+        # Only resume if it's still the same file on the server
+        if state["url"] != url or state["size"] != size or state["etag"] != head.headers.get("ETag"):
+            state = None
+    if state is None:
+        part_size = -(-size // DOWNLOAD_PARTS)
+        state = {
+            "url": url,
+            "size": size,
+            "etag": head.headers.get("ETag"),
+            "parts": [[start, min(start + part_size, size) - 1, start] for start in range(0, size, part_size)],
+        }
+        with open(path, "wb") as f:
+            f.truncate(size)
+        save_download_state(path, state)
+
+    done = sum(part[2] - part[0] for part in state["parts"])
+    if done:
+        print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.CYAN}Resuming the download from {done // (1024 * 1024)} MiB.{Style.RESET_ALL}")
+    lock = threading.Lock()
+    pbar = tqdm(total=size, initial=done, unit="B", unit_scale=True, unit_divisor=1024)
+    pending = [part for part in state["parts"] if part[2] <= part[1]]
+    stop = threading.Event()
+    try:
+        with ThreadPoolExecutor(max_workers=DOWNLOAD_PARTS) as executor:
+            futures = [executor.submit(download_part, url, path, part, state, lock, pbar, stop) for part in pending]
+            try:
+                # The first range to fail stops the download, whatever its position
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                # The other ranges stop at their next chunk, instead of downloading until the end
+                stop.set()
+                executor.shutdown(cancel_futures=True)
+                raise
+    except (IOError, requests.RequestException, urllib3.exceptions.HTTPError) as e:
+        sys.exit(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.RED}The download was interrupted ({e}), run the seed again to resume it.{Style.RESET_ALL}")
+    except KeyboardInterrupt:
+        sys.exit(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.RED}The download was interrupted, run the seed again to resume it.{Style.RESET_ALL}")
+    finally:
+        pbar.close()
+
+    if not verify_download(path, head.headers):
+        os.remove(path)
+        os.remove(f"{path}.state")
+        sys.exit(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.RED}The downloaded DB dump doesn't match its checksum, please run the seed again.{Style.RESET_ALL}")
+    os.remove(f"{path}.state")
+    return size
+
+
+@contextmanager
+def cache_lock(path: str, shared: bool = False, wait: bool = True) -> Iterator[bool]:
+    # Several dev envs can use the cache at the same time, so every entry has a <path>.lock
+    # file, held exclusively while writing it and shared while reading it. Without wait,
+    # yields False instead of waiting when someone else holds it
+    with open(f"{path}.lock", "a") as f:
+        mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        try:
+            fcntl.flock(f, mode | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if not wait:
+                yield False
+                return
+            print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.CYAN}Waiting for another run using the cached {os.path.basename(path)}..{Style.RESET_ALL}")
+            with timed(f"wait for cached {os.path.basename(path)}"):
+                fcntl.flock(f, mode)
+        # Closing the file releases the lock
+        yield True
+
+
+def cached_dump_path(head: "requests.Response") -> Optional[str]:
+    # Dumps are cached by content, using the SHA1 sent by Backblaze or the ETag
+    if CACHE_DIR is None:
+        return None
+    key = head.headers.get("x-bz-content-sha1", "")
+    if len(key) != 40:
+        etag = head.headers.get("ETag")
+        if not etag:
+            return None
+        key = hashlib.sha1(f"{etag}:{head.headers.get('Content-Length')}".encode()).hexdigest()
+    os.makedirs(f"{CACHE_DIR}/dumps", exist_ok=True)
+    return f"{CACHE_DIR}/dumps/{key}.sql.gz"
+
+
+def prune_cached_dumps(keep: str) -> None:
+    # Dumps are a few GBs each, so only the latest one is kept around. The ones another
+    # seed is still importing are left for the next time
+    folder = f"{CACHE_DIR}/dumps"
+    for key in {file.split(".", 1)[0] for file in os.listdir(folder)}:
+        dump = f"{folder}/{key}.sql.gz"
+        if dump == keep:
+            continue
+        with cache_lock(dump, wait=False) as locked:
+            if not locked:
+                continue
+            # The lock files stay, someone may already be waiting on them
+            for file in os.listdir(folder):
+                path = f"{folder}/{file}"
+                if path == dump or (path.startswith(f"{dump}.") and not file.endswith(".lock")):
+                    # Converted dumps are directories
+                    rmtree(path) if os.path.isdir(path) else os.remove(path)
+
+
+def git_clone(url: str, dest: str, branch: Optional[str] = None, shallow: bool = False) -> None:
+    # Clone url into dest, going through a bare mirror in the cache when it's enabled.
+    # The mirror is only fetched, and the clone itself is a local one
+    args = ['-b', branch] if branch else []
+    # A leftover from an interrupted setup is cloned again
+    if os.path.exists(dest):
+        rmtree(dest)
+    if CACHE_DIR is None:
+        run_command(['git', 'clone', *args, *(['--depth', '1'] if shallow else []), url, dest])
+        return
+
+    owner, repo = url.rstrip('/').removesuffix('.git').split('/')[-2:]
+    mirror = f"{CACHE_DIR}/git/{owner}-{repo}.git"
+    os.makedirs(f"{CACHE_DIR}/git", exist_ok=True)
+    # Another setup may be cloning or updating the same mirror
+    with cache_lock(mirror):
+        # Caches made with clone --mirror also fetch every refs/pull/* ref from GitHub, start those over
+        is_mirror = subprocess.run(['git', 'config', '--get', 'remote.origin.mirror'], cwd=mirror, capture_output=True, text=True) if os.path.isdir(mirror) else None
+        if is_mirror is not None and is_mirror.stdout.strip() == "true":
+            rmtree(mirror)
+        if os.path.isdir(mirror):
+            print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Updating cached {Fore.CYAN}{owner}/{repo}{Fore.GREEN}.{Style.RESET_ALL}")
+            try:
+                run_command(['git', 'fetch', '--prune', 'origin'], cwd=mirror)
+            except CommandFailed:
+                print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.RED}Could not update the cache, using the cached copy as it is.{Style.RESET_ALL}")
+        else:
+            # Only the branches (and the tags pointing to them) are needed by the dev env. A bare
+            # clone has no fetch refspec, so it's set for the next updates
+            run_command(['git', 'clone', '--bare', url, mirror])
+            run_command(['git', 'config', 'remote.origin.fetch', '+refs/heads/*:refs/heads/*'], cwd=mirror)
+
+        # Local clones hardlink the objects, so there's no need for a shallow one
+        run_command(['git', 'clone', *args, mirror, dest])
+    # Point origin back to GitHub, so the dev env doesn't depend on the cache
+    run_command(['git', 'remote', 'set-url', 'origin', url], cwd=dest)
+
+
+def dump_fingerprint() -> Optional[str]:
+    # The dump changes when the ETag does, None if it can't be checked right now
+    import requests
+    try:
+        head = requests.head(KITSU_DB_DUMP, allow_redirects=True, timeout=30)
+        head.raise_for_status()
+    except requests.RequestException:
+        return None
+    return head.headers.get("x-bz-content-sha1") or head.headers.get("ETag")
+
+
+def fetch_dump(dev_env: str) -> tuple:
+    # Get the dump on disk (or in the cache). Returns its path, its size (None if the
+    # server can't do range requests and the dump must be streamed) and if it's cached
+    import requests
+    KITSU_TOOLS_DIR = os.path.abspath(dev_env)
+
+    with timed("fetch dump") as event:
+        head = requests.head(KITSU_DB_DUMP, allow_redirects=True)
+        head.raise_for_status()
+        cached_path = cached_dump_path(head)
+        dump_path = cached_path or f"{KITSU_TOOLS_DIR}/latest.sql.gz"
+
+        # Another seed may be downloading the same dump, it's checked again once it's done
+        with cache_lock(cached_path) if cached_path is not None else nullcontext():
+            if cached_path is not None and os.path.exists(cached_path) and not os.path.exists(f"{cached_path}.state"):
+                print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Using the cached DB dump.{Style.RESET_ALL}")
+                size = os.path.getsize(cached_path)
+                event["cached"] = True
+            else:
+                # We first download the db dump with parallel range requests, so an interrupted
+                # download can be resumed by running the seed again
+                print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.CYAN}Downloading the DB dump, please wait for the download to complete.{Style.RESET_ALL}")
+                size = download_dump(KITSU_DB_DUMP, dump_path, head)
+                if size is not None and cached_path is not None:
+                    prune_cached_dumps(cached_path)
+        event["bytes"] = size
+        return dump_path, size, cached_path is not None
+
+
+def import_database(dev_env: str, dump: tuple) -> None:
     # Since bin/seed download a .gz file, it should first extract the db dump, but
     # For some reason the downloaded file is just a plain SQL file, so we must
-    # Import it using psql
+    # Import it using psql. Custom and directory format dumps are restored in parallel
     KITSU_TOOLS_DIR = os.path.abspath(dev_env)
-    
-    # We first download the db dump
-    print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.CYAN}Downloading the DB dump, please wait for the download to complete and {Fore.RED}do not{Fore.CYAN} interrupt the process.{Style.RESET_ALL}")
-    # Code from https://stackoverflow.com/questions/56795227/how-do-i-make-progress-bar-while-downloading-file-in-python
-    with requests.get(KITSU_DB_DUMP, stream=True) as r:
-        with open(f"{KITSU_TOOLS_DIR}/latest.sql.gz", 'wb') as f:
-            pbar = tqdm(total=int(r.headers['Content-Length']))
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-                    pbar.update(len(chunk))
-    print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Download completed! Now we'll import it, please wait..{Style.RESET_ALL}\n")
-    
-    # And import it
-    # Instead of using the provided bin/seed, we will directly call docker compose exec 
-    # So we don't get "the input device is not a TTY" error message!
-    
-    # Before seeding we drop the schema manually
-    dockercommand = "docker compose exec -T -i postgres psql --username=kitsu_development --host=postgres -d kitsu_development --command"
-    dockercommand = dockercommand.split()
-    dockercommand.append("DROP SCHEMA public CASCADE;CREATE SCHEMA public;") # Append the query as an unique list element
-
-    docker_comp = subprocess.Popen(dockercommand, cwd=KITSU_TOOLS_DIR)
-    docker_comp.wait()
-
-    # Use a string since it's faster for me than writing all that stuff into a list 
-    # The -T parameter disable TTY, see https://docs.docker.com/engine/reference/commandline/compose_exec/
-    # Also we only seed the kitsu_development DB 
-    dockercommand = "docker compose exec -T -i postgres psql --username=kitsu_development --host=postgres kitsu_development"
-    
-    # Open the DB dump as a file and pass it to sdtin
-    # Set the cwd to the kitsu-tools one so we're sure that the postgres container is found
-    with gzip.open(f"{KITSU_TOOLS_DIR}/latest.sql.gz", 'rb') as f:
-        with open(f"{KITSU_TOOLS_DIR}/latest.sql", 'wb') as dump:
-            copyfileobj(f, dump)
-    os.remove(f"{KITSU_TOOLS_DIR}/latest.sql.gz")
-    with open(f"{KITSU_TOOLS_DIR}/latest.sql", 'r') as f:
-        docker_comp = subprocess.Popen(dockercommand.split(), cwd=KITSU_TOOLS_DIR, stdin=f)
-        docker_comp.wait()
+    dump_path, size, cached = dump
+    # A cached dump is kept from being pruned by another seed until it's imported
+    in_cache = CACHE_DIR is not None and dump_path.startswith(f"{CACHE_DIR}/")
+    with cache_lock(dump_path, shared=True) if in_cache else nullcontext():
+        if in_cache and not os.path.exists(dump_path):
+            raise CommandFailed("the cached DB dump was replaced by a newer one meanwhile, run the seed again")
+        # The cached dump may have been converted by a previous parallel restore
+        converted = f"{dump_path}.dir" if PARALLEL_RESTORE and in_cache else None
+        if converted is not None and os.path.isdir(converted):
+            dump_path = converted
+        restore_format = dump_format(dump_path) if size is not None or dump_path == converted else "plain-gzip"
+
+        # Before seeding we drop the schema manually
+        # Instead of using the provided bin/seed, we will directly call docker compose exec 
+        # So we don't get "the input device is not a TTY" error message!
+        dockercommand = "docker compose exec -T -i postgres psql --username=kitsu_development --host=postgres -d kitsu_development --command"
+        dockercommand = dockercommand.split()
+        dockercommand.append("DROP SCHEMA public CASCADE;CREATE SCHEMA public;") # Append the query as an unique list element
+
+        run_command(dockercommand, cwd=KITSU_TOOLS_DIR)
+
+        # Then we import it, decompressing it on the fly
+        # Set the cwd to the kitsu-tools one so we're sure that the postgres container is found
+        print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.CYAN}Importing the DB dump, please wait for the import to complete and {Fore.RED}do not{Fore.CYAN} interrupt the process.{Style.RESET_ALL}")
+        if restore_format in ("custom", "directory"):
+            with timed("restore dump") as event:
+                event["format"] = restore_format
+                restore_dump(dump_path, KITSU_TOOLS_DIR)
+            print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Restored the {restore_format} dump, now running the migrations..{Style.RESET_ALL}\n")
+        else:
+            with timed("import dump") as event:
+                if size is not None:
+                    with open(dump_path, "rb") as f:
+                        # A plain dump given by the user is read as it is
+                        downloaded, rows = import_dump(iter(lambda: f.read(DUMP_CHUNK_SIZE), b""), size, PSQL_COMMAND, KITSU_TOOLS_DIR, restore_format == "plain-gzip")
+                    # After importing, we'll delete the DB dump since it's not used anymore and to free up space
+                    if not cached:
+                        os.remove(dump_path)
+                else:
+                    # The server can't do range requests, so we just import the dump while downloading it
+                    downloaded, rows = stream_dump(KITSU_DB_DUMP, PSQL_COMMAND, KITSU_TOOLS_DIR)
+                event.update(format=restore_format if size is not None else "stream", bytes=downloaded, rows=rows)
+            print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Imported {Fore.CYAN}{rows}{Fore.GREEN} rows ({downloaded // (1024 * 1024)} MiB), now running the migrations..{Style.RESET_ALL}\n")
+            # Saved before the migrations, so restoring it is the same as importing the plain dump.
+            # Another seed of the same dump may be converting it already
+            if converted is not None:
+                with cache_lock(converted, wait=False) as locked:
+                    if locked and not os.path.isdir(converted):
+                        with timed("convert dump"):
+                            convert_dump(converted, KITSU_TOOLS_DIR)
 
     # And run the migrations
-    rake = subprocess.Popen([f'{KITSU_TOOLS_DIR}/bin/rake', 'db:migrate'])
-    rake.wait()
-    rake = subprocess.Popen([f'{KITSU_TOOLS_DIR}/bin/rake', 'chewy:reset']) # Reindex DB
-    rake.wait()
+    run_command([f'{KITSU_TOOLS_DIR}/bin/rake', 'db:migrate'])
+    run_command([f'{KITSU_TOOLS_DIR}/bin/rake', 'chewy:reset']) # Reindex DB
 
-    # After importing, we'll delete the DB dump since it's not used anymore and to free up space
-    os.remove(f"{KITSU_TOOLS_DIR}/latest.sql")
     print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Database imported (anime.sql > kitsu_development)!{Style.RESET_ALL}\n")
 
 
+def seed_database(dev_env: str, dump_file: Optional[str] = None) -> None:
+    with recording("seed", os.path.dirname(os.path.abspath(dev_env))):
+        with timed("wait for services"):
+            check_running(dev_env, ["postgres", "typesense"])
+            wait_ready({"postgres": lambda: postgres_ready(dev_env), "typesense": lambda: typesense_ready(dev_env)}, TOOLS_READY_TIMEOUT)
+        if dump_file is None:
+            import_database(dev_env, fetch_dump(dev_env))
+            return
+        # A dump given by the user is never deleted
+        dump_file = os.path.abspath(dump_file)
+        import_database(dev_env, (dump_file, 0 if os.path.isdir(dump_file) else os.path.getsize(dump_file), True))
+
+
 def setup_web_branch(path: str, react: bool = False) -> None:
     if os.path.exists(f'{path}/kitsu-tools/web/'):
         rmtree(f'{path}/kitsu-tools/web', ignore_errors=True)
-    with open(f"{path}/kitsu-tools/docker-compose.yml", 'r') as f:
-        yamlparser = yaml.YAML()
-        # Preserve the quotes etc.
-        yamlparser.preserve_quotes = True
-
-        contents = yamlparser.load(f)
     if react:
         print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Cloning client (from {Fore.CYAN}hummingbird-me/kitsu-web{Fore.GREEN}).{Style.RESET_ALL}\n")
-        gitclone = subprocess.Popen(['git', 'clone', '-b', 'the-future', "https://github.com/hummingbird-me/kitsu-web.git", f"{path}/kitsu-tools/web"])
-        gitclone.wait()
-        contents["services"]["web"]["tmpfs"] = ["/opt/kitsu/client/node_modules/.vite/cache"]
+        git_clone("https://github.com/hummingbird-me/kitsu-web.git", f"{path}/kitsu-tools/web", branch='the-future')
     else:
         print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Cloning client (from {Fore.CYAN}ShomyKohai/kitsu-web@the-future{Fore.GREEN}).{Style.RESET_ALL}\n")
-        gitclone = subprocess.Popen(['git', 'clone', '-b', 'the-future', "https://github.com/ShomyKohai/kitsu-web.git", f"{path}/kitsu-tools/web"])
-        gitclone.wait()
+        git_clone("https://github.com/ShomyKohai/kitsu-web.git", f"{path}/kitsu-tools/web", branch='the-future')
 
         # Before building the environment, for some reason the kitsu-web won't start until the
         # node-modules folder is generated, so we run yarn install before building with bin/build
         print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Running yarn on client.{Style.RESET_ALL}\n")
-        yarn = subprocess.Popen([f'yarn', 'install'], cwd=f"{path}/kitsu-tools/web")
-        yarn.wait() 
+        run_command(['yarn', 'install'], cwd=f"{path}/kitsu-tools/web")
+
+
+def web_fingerprint(tools: str, react: bool) -> Optional[str]:
+    head = git_head(f"{tools}/web")
+    # The old client also needs its node_modules folder
+    if head is None or (not react and not os.path.isdir(f"{tools}/web/node_modules")):
+        return None
+    return f"{head}:{file_hash(f'{tools}/web/yarn.lock')}:{react}"
+
 
+def patch_compose(path: str, react: bool = False) -> None:
+    # Apply changes to the kitsu-tools docker-compose.yml file to use the correct typesense image
+    from ruamel import yaml
+    with open(f"{path}/kitsu-tools/docker-compose.yml", 'r') as f:
+        yamlparser = yaml.YAML()
+        # Preserve the quotes etc.
+        yamlparser.preserve_quotes = True
+
+        contents = yamlparser.load(f)
+
+    # Replace only if the typesense image is wrong
+    if contents["services"]["typesense"]["image"] == "typesense:0.25.0.rc54":
+        contents["services"]["typesense"]["image"] = "typesense/typesense:0.25.0.rc54"
+        print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Fixed typesense image.{Style.RESET_ALL}\n")
+
+    # The client cache folder depends on the branch we use
+    if react:
+        contents["services"]["web"]["tmpfs"] = ["/opt/kitsu/client/node_modules/.vite/cache"]
+    else:
         contents["services"]["web"]["tmpfs"] = ["/opt/kitsu/client/tmp"]
 
+    # Then dump the changes
+    with open(f"{path}/kitsu-tools/docker-compose.yml", 'w') as f:
+        yamlparser.dump(contents, f)
 
-def setup(path: str, should_seed: bool = False, setup_react: bool = False) -> None:
-    cwd = path
-    
+
+def check_requirements() -> None:
     # Check if Docker & Docker Compose are installed
     if which("docker") is None:
         sys.exit(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.RED}Docker is not installed. Please install it and run the script again.{Style.RESET_ALL}")
@@ -228,60 +1475,58 @@ def setup(path: str, should_seed: bool = False, setup_react: bool = False) -> No
         sys.exit(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.RED}Yarn is not installed. Please install yarn before running the script{Style.RESET_ALL}")
     else: print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Yarn was found.{Style.RESET_ALL}\n")
 
-    # Now clone the kitsu-tools repo
-    gitclone = subprocess.Popen(['git', 'clone', '--depth', '1', "https://github.com/hummingbird-me/kitsu-tools.git", f"{cwd}/kitsu-tools"])
-    gitclone.wait()
 
-    # Now apply changes to the kitsu-tools docker-compose.yml file to use the correct typesense image
-    with open(f"{cwd}/kitsu-tools/docker-compose.yml", 'r') as f:
-        yamlparser = yaml.YAML()
-        # Preserve the quotes etc.
-        yamlparser.preserve_quotes = True
-
-        contents = yamlparser.load(f)
-
-    # Replace only if the typesense image is wrong
-    if contents["services"]["typesense"]["image"] == "typesense:0.25.0.rc54":
-        contents["services"]["typesense"]["image"] = "typesense/typesense:0.25.0.rc54"
-        print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Fixed typesense image.{Style.RESET_ALL}\n")
-
-    # Then dump the changes
-    with open(f"{cwd}/kitsu-tools/docker-compose.yml", 'w') as f:
-        yamlparser.dump(contents, f)
-    
-    # Clone the server
-    print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Cloning server.{Style.RESET_ALL}\n")
-    gitclone = subprocess.Popen(['git', 'clone', "https://github.com/hummingbird-me/kitsu-server.git", f"{cwd}/kitsu-tools/server"])
-    gitclone.wait()
-
-    # Then setup the client
-    setup_web_branch(cwd, setup_react)
-
-    # Fix the server not booting because of prometheus (Temporary solution)
-    print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Fixing server!.{Style.RESET_ALL}\n")
-    fix_server = subprocess.Popen(['git', 'reset', '--hard', '99cc3e9'], cwd=f"{cwd}/kitsu-tools/server")
-    fix_server.wait()
-
-    # Build the environment!
-    print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Finally we build!.{Style.RESET_ALL}\n")
-    docker_comp = subprocess.Popen([f'{cwd}/kitsu-tools/bin/build'])
-    docker_comp.wait()
-
-    # And then we start the containers just to be sure
-    docker_comp = subprocess.Popen([f'{cwd}/kitsu-tools/bin/start'])
-    docker_comp.wait()
-
-    # HACK: We run db:setup on rails to be sure that we don't encounter an issue when running migrations
-    rails_console = subprocess.Popen(["bin/rails", "db:setup"], cwd=f'{cwd}/kitsu-tools')  
-
-    # Now we seed the database if the user chose to
-    if should_seed: seed_database(cwd)
+def setup(path: str, should_seed: bool = False, setup_react: bool = False) -> None:
+    cwd = path
+    tools = f"{cwd}/kitsu-tools"
+    check_requirements()
 
-    # Finally we have the last steps
+    # Every step only waits for the steps it really needs, everything else runs in parallel
+    results: dict = {}
+    tasks = [
+        # Now clone the kitsu-tools repo
+        SetupTask("clone tools", lambda: git_clone("https://github.com/hummingbird-me/kitsu-tools.git", tools, shallow=True),
+            fingerprint=lambda: git_head(tools)),
+        SetupTask("patch compose", lambda: patch_compose(cwd, setup_react), ["clone tools"],
+            fingerprint=lambda: f"{file_hash(f'{tools}/docker-compose.yml')}:{setup_react}"),
+        # Clone the server
+        SetupTask("clone server", lambda: git_clone("https://github.com/hummingbird-me/kitsu-server.git", f"{tools}/server"), ["clone tools"],
+            fingerprint=lambda: "cloned" if git_head(f"{tools}/server") else None),
+        # Fix the server not booting because of prometheus (Temporary solution)
+        SetupTask("fix server", lambda: run_command(['git', 'reset', '--hard', '99cc3e9'], cwd=f"{tools}/server"), ["clone server"],
+            fingerprint=lambda: git_head(f"{tools}/server")),
+        # Then setup the client
+        SetupTask("setup web", lambda: setup_web_branch(cwd, setup_react), ["clone tools"],
+            fingerprint=lambda: web_fingerprint(tools, setup_react)),
+        # Build the environment!
+        SetupTask("build", lambda: run_command([f'{tools}/bin/build']), ["patch compose", "fix server", "setup web"],
+            fingerprint=lambda: "build"),
+        # And then we start the containers just to be sure, this one always runs
+        SetupTask("start", lambda: run_command([f'{tools}/bin/start']), ["build"]),
+        # The next steps start as soon as the services they need answer, instead of right after bin/start
+        SetupTask("postgres ready", lambda: wait_ready({"postgres": lambda: postgres_ready(tools)}), ["start"]),
+        SetupTask("typesense ready", lambda: wait_ready({"typesense": lambda: typesense_ready(tools)}), ["start"]),
+        # HACK: We run db:setup on rails to be sure that we don't encounter an issue when running migrations.
+        # It loads the schema again, so it must not run twice on the same server version
+        SetupTask("db setup", lambda: run_command(["bin/rails", "db:setup"], cwd=tools), ["postgres ready"],
+            fingerprint=lambda: "db setup"),
+    ]
+    # Now we seed the database if the user chose to, the dump is downloaded while the images build
+    if should_seed:
+        tasks += [
+            SetupTask("download dump", lambda: fetch_dump(tools), ["clone tools"], fingerprint=dump_fingerprint),
+            # The download is skipped when the dump didn't change, so it may have to be fetched here
+            SetupTask("seed", lambda: import_database(tools, results.get("download dump") or fetch_dump(tools)), ["db setup", "download dump", "typesense ready"],
+                fingerprint=lambda: "seed"),
+        ]
+    # Finally we enable registrations in the server so it's possible to create an account from the web page
+    tasks.append(SetupTask("enable registrations", lambda: enable_flipper_flags(["registration"], tools), ["seed" if should_seed else "db setup"],
+        fingerprint=lambda: "registration"))
+    # The setup is only done when the API answers
+    tasks.append(SetupTask("api ready", lambda: wait_ready({"API": api_ready}), ["enable registrations"]))
 
-    # First we enable registrations in the server so it's possible to create an account from the web page
-    print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Now we enable registrations in the server!{Style.RESET_ALL}")
-    enable_flipper_flag("registration", f"{cwd}/kitsu-tools")
+    with recording("setup", cwd):
+        run_tasks(tasks, f"{cwd}/.kitsu-builder/logs", results, os.path.join(cwd, SETUP_STATE))
 
     print(f"{Fore.YELLOW}Kitsu Builder {Fore.WHITE}> {Fore.GREEN}Setup completed!{Style.RESET_ALL}")
 
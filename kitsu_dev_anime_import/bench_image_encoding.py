@@ -0,0 +1,93 @@
+import argparse
+import json
+import random
+import time
+import typing
+
+import kitsu_dev_anime_import as importer
+
+"""
+Benchmark of the image column encoding done for every media and character.
+
+Uses the media of a snapshot made with --export, or generated payloads shaped
+like the GraphQL ones: a poster and a banner per media, and characters shared
+between media like in the real data.
+"""
+
+POSTER_VIEWS = [("tiny", 110, 156), ("small", 284, 402), ("medium", 390, 554), ("large", 550, 780)]
+BANNER_VIEWS = [("tiny", 840, 200), ("small", 1680, 400), ("large", 3360, 800)]
+CHARACTER_VIEWS = [("medium", 225, 350)]
+
+
+def fake_image(kind: str, key: int, views: list) -> dict:
+    base = f"https://media.kitsu.io/{kind}/{key}"
+    return {
+        "blurhash": "LKO2?U%2Tw=w]~RBVZRi};RPxuwH",
+        "original": {"name": "original", "url": f"{base}/original.jpg", "width": views[-1][1], "height": views[-1][2]},
+        "views": [{"name": name, "url": f"{base}/{name}.jpg", "width": width, "height": height} for name, width, height in views],
+    }
+
+
+def fake_media(count: int, characters_per_media: int, shared_characters: int) -> typing.List[dict]:
+    rng = random.Random(42)
+    return [
+        {
+            "posterImage": fake_image("anime/poster_images", media, POSTER_VIEWS),
+            "bannerImage": fake_image("anime/cover_images", media, BANNER_VIEWS),
+            "characters": {"nodes": [
+                {"character": {"image": fake_image("characters/images", rng.randrange(shared_characters), CHARACTER_VIEWS)}}
+                for _ in range(characters_per_media)
+            ]},
+        }
+        for media in range(count)
+    ]
+
+
+def payloads(media: typing.List[dict]) -> typing.List[tuple]:
+    # (image, is a character image) in the order the importer encodes them
+    images = []
+    for node in media:
+        images.append((node.get("posterImage"), False))
+        images.append((node.get("bannerImage"), False))
+        for character in (node.get("characters") or {}).get("nodes", []):
+            images.append((character["character"].get("image"), True))
+    return images
+
+
+def bench(name: str, encode: typing.Callable[[typing.Optional[dict], bool], str], images: typing.List[tuple], rounds: int) -> float:
+    best = float("inf")
+    for _ in range(rounds):
+        importer.image_cache.clear()
+        started = time.perf_counter()
+        for image, character in images:
+            encode(image, character)
+        best = min(best, time.perf_counter() - started)
+    print(f"  {name:<28} {best * 1000:9.1f}ms  {best / len(images) * 1e6:6.2f}us/image")
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the image column encoding of the importer.")
+    parser.add_argument("--snapshot", "-s", type=str, help="Use the media of this snapshot folder instead of generated ones.")
+    parser.add_argument("--media", type=int, default=2000, help="How many media to generate.")
+    parser.add_argument("--characters", type=int, default=25, help="Characters per generated media.")
+    parser.add_argument("--shared", type=int, default=5000, help="Distinct characters the generated media pick from.")
+    parser.add_argument("--rounds", type=int, default=5, help="Runs of each variant, the best one is reported.")
+    args = parser.parse_args()
+
+    if args.snapshot is not None:
+        media = [node for media_type in ("anime", "manga") for node in importer.read_snapshot(args.snapshot, media_type)]
+    else:
+        media = fake_media(args.media, args.characters, args.shared)
+    images = payloads(media)
+    characters = [image for image, character in images if character and image]
+    print(f"{len(media)} media, {len(images)} images, {len({image['original']['url'] for image in characters})} distinct character images")
+
+    baseline = bench("json.dumps", lambda image, _: json.dumps(importer.convert_media_images(image)), images, args.rounds)
+    bench("shared encoder, no cache", lambda image, _: importer.encode_media_images(image), images, args.rounds)
+    memoized = bench("encode_media_images", importer.encode_media_images, images, args.rounds)
+    print(f"  {baseline / memoized:.1f}x faster than json.dumps, {len(importer.image_cache)} images cached (max {importer.IMAGE_CACHE_SIZE})")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,17 @@
+import argparse
 import askitsu
 import asyncio
 import asyncpg
+import contextlib
 import enum
+import gzip
 import json
+import mmap
+import os
+import re
+import statistics
+import sys
+import time
 import traceback
 import typing
 
@@ -38,6 +47,16 @@ class Subtype(enum.Enum):
     MUSIC: int = 5
 
 
+class MangaSubtype(enum.Enum):
+    MANGA: int = 0
+    NOVEL: int = 1
+    MANHUA: int = 2
+    ONESHOT: int = 3
+    DOUJIN: int = 4
+    MANHWA: int = 5
+    OEL: int = 6
+
+
 class AgeRating(enum.Enum):
     G: int = 0
     PG: int = 1
@@ -52,13 +71,24 @@ class CharacterRole(enum.Enum):
     CAMEO: int = 3
 
 
-gqlquery = """
-query anime($cursor: String){
-  anime(first: 20, after: $cursor){
-    edges{
-      cursor
-    }
-    nodes{
+image_gqlfields = """
+          blurhash
+          original{
+            name
+            url
+            width
+            height
+          }
+          views{
+            name
+            url
+            width
+            height
+          }
+"""
+
+# Fields fetched for every media type, the ones only a type has are added by media_gqlquery
+media_gqlfields = """
         id
         slug
         createdAt
@@ -68,14 +98,7 @@ query anime($cursor: String){
         description
         status
         sfw
-        animesub: subtype
         ageRating
-        endDate
-        season
-        episodeCount
-        episodeLength
-        totalLength
-        youtubeTrailerVideoId
         averageRatingRank
         averageRating
         userCountRank
@@ -96,21 +119,7 @@ query anime($cursor: String){
             updatedAt
             character{
               id
-              image{
-                blurhash
-                original{
-                  name
-                  url
-                  width
-                  height
-                }
-                views{
-                  name
-                  url
-                  width
-                  height
-                }
-              }
+              image{""" + image_gqlfields + """              }
               names{
                 localized
                 canonical
@@ -128,43 +137,38 @@ query anime($cursor: String){
           }
         }
 
-      	posterImage{
-          blurhash
-          original{
-            name
-            url
-            width
-            height
-          }
-          views{
-            name
-            url
-            width
-            height
-          }
-        }
+      	posterImage{""" + image_gqlfields + """        }
 
-        bannerImage{
-          blurhash
-          original{
-            name
-            url
-            width
-            height
-          }
-          views{
-            name
-            url
-            width
-            height
-          }     
-        }
-      
-    }
-  }
-}
+        bannerImage{""" + image_gqlfields + """        }
 """
 
+
+def media_gqlquery(media_type: str, fields: str) -> str:
+    return (
+        f"query {media_type}($cursor: String){{\n"
+        f"  {media_type}(first: 20, after: $cursor){{\n"
+        "    edges{\n"
+        "      cursor\n"
+        "    }\n"
+        "    nodes{" + fields + media_gqlfields + "    }\n"
+        "  }\n"
+        "}\n"
+    )
+
+
+gqlquery = media_gqlquery("anime", """
+        animesub: subtype
+        season
+        episodeCount
+        episodeLength
+        totalLength
+        youtubeTrailerVideoId""")
+
+manga_gqlquery = media_gqlquery("manga", """
+        mangasub: subtype
+        chapterCount
+        volumeCount""")
+
 categories_gqlquery = """
 query {
   categories(first: 243){
@@ -188,38 +192,6 @@ query {
 """
 
 
-query_anime = """INSERT INTO public.anime(
-    id,
-    slug,
-    age_rating,
-    episode_count,
-    episode_length,
-    description,
-    youtube_video_id,
-    created_at,
-    updated_at,
-    average_rating,
-    user_count,
-    age_rating_guide,
-    subtype,
-    start_date,
-    end_date,
-    titles,
-    canonical_title,
-    popularity_rank,
-    rating_rank,
-    favorites_count,
-    tba,
-    episode_count_guess,
-    total_length,
-    origin_languages,
-    origin_countries,
-    original_locale,
-    poster_image_data,
-    cover_image_data
-  )
-	VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, $15, $16, $17, $18, $19, $20, $21, $22, $23, $24, $25, $26, $27, $28);"""
-
 query_genres = """
   INSERT INTO public.anime_genres(
   anime_id,
@@ -228,6 +200,69 @@ query_genres = """
   VALUES ($1, $2)
 """
 
+query_manga_genres = """
+  INSERT INTO public.genres_manga(
+  manga_id,
+  genre_id
+  )
+  VALUES ($1, $2)
+"""
+
+# Columns of the media tables and how to get them from the askitsu media, the
+# insert queries are built from them. Every table starts with the id column
+media_columns = {
+    "slug": lambda media: media.slug,
+    "age_rating": lambda media: AgeRating[media.age_rating].value if media._attributes["ageRating"] is not None else None,
+    "description": lambda media: dump_json({"en": media.description}),
+    "created_at": lambda media: media.created_at,
+    "updated_at": lambda media: media.updated_at,
+    "average_rating": lambda media: media.rating,
+    "user_count": lambda media: media._attributes.get("userCount", 0),
+    "age_rating_guide": lambda media: media._attributes.get("ageRatingGuide", ""),
+    "start_date": lambda media: media.started_at,
+    "end_date": lambda media: media.ended_at,
+    "titles": lambda media: convert_titles(media._titles),
+    "canonical_title": lambda media: match_canonical_title(media._titles),
+    "popularity_rank": lambda media: media.popularity_rank,
+    "rating_rank": lambda media: media.rating_rank,
+    "favorites_count": lambda media: media._attributes.get("favoritesCount", 0),
+    "tba": lambda media: media._attributes.get("tba", ""),
+    "origin_languages": lambda media: media._attributes.get("origin_languages", None),
+    "origin_countries": lambda media: media._attributes.get("origin_countries", None),
+    "original_locale": lambda media: media._attributes.get("original_locale", ""),
+    "poster_image_data": lambda media: encode_media_images(media._attributes["posterImage"]),
+    "cover_image_data": lambda media: encode_media_images(media._attributes["bannerImage"]),
+}
+
+# The columns only one media type has
+media_type_columns = {
+    "anime": {
+        "episode_count": lambda media: media.episode_count,
+        "episode_length": lambda media: media.episode_length,
+        "youtube_video_id": lambda media: media.yt_id,
+        "subtype": lambda media: Subtype[media.subtype].value,
+        "episode_count_guess": lambda media: media.episode_count,
+        "total_length": lambda media: media.total_length,
+    },
+    "manga": {
+        "chapter_count": lambda media: media.chapter_count,
+        "volume_count": lambda media: media.volume_count,
+        "subtype": lambda media: MangaSubtype[media.subtype].value,
+        "chapter_count_guess": lambda media: media.chapter_count,
+    },
+}
+
+
+def media_insert_query(table: str, columns: typing.List[str]) -> str:
+    return (
+        f"INSERT INTO public.{table}(\n    " + ",\n    ".join(["id", *columns]) + "\n  )\n"
+        f"\tVALUES ({', '.join(f'${n}' for n in range(1, len(columns) + 2))});"
+    )
+
+
+query_anime = media_insert_query("anime", [*media_columns, *media_type_columns["anime"]])
+query_manga = media_insert_query("manga", [*media_columns, *media_type_columns["manga"]])
+
 query_anime_character = """
   INSERT INTO public.anime_characters (
     anime_id,
@@ -303,46 +338,337 @@ query_categories = """
 """
 
 imports = 0
-id = 0
-next_cursor = ""
-anime: typing.List[askitsu.Anime] = []
+next_id = {"anime": 0, "manga": 0}
+character_id = 1
+next_cursor = {"anime": "", "manga": ""}
+
+# Every image url starts with "https://media.kitsu.io/", which is not stored in the DB
+MEDIA_URL_PREFIX_LENGTH = 23
+# Encoded character image columns, keyed by the original image url
+image_cache: typing.Dict[str, str] = {}
+# The oldest entries are dropped past this size, so long imports don't keep every image
+IMAGE_CACHE_SIZE = 10000
+# Our payloads are plain dicts, so there's no need to check for circular references
+dump_json = json.JSONEncoder(check_circular=False, separators=(",", ":")).encode
+
+# How many records are written in a single snapshot shard
+SNAPSHOT_SHARD_SIZE = 1000
+
+# How many fetched media may wait to be inserted, per media type.
+# When the queue is full the fetcher waits, when it's empty the inserters do
+MEDIA_QUEUE_SIZE = 100
+# Concurrent inserters per media type, they all share the same DB pool
+INSERT_WORKERS = 4
+
+# How often (in seconds) the progress line is printed while importing
+PROGRESS_INTERVAL = 5
+
+
+class ImportMetrics:
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.pages_fetched = 0
+        self.graphql_latency: typing.List[float] = []
+        self.insert_latency: typing.Dict[str, typing.List[float]] = {}
+        self.rows: typing.Dict[str, int] = {}
+        self.imported: typing.Dict[str, int] = {}
+        self.queues: typing.Dict[str, asyncio.Queue] = {}
+        self.queue_samples: typing.Dict[str, typing.List[int]] = {}
+        self.phases: typing.Dict[str, float] = {}
+
+    def record_insert(self, table: str, rows: int, latency: float) -> None:
+        self.rows[table] = self.rows.get(table, 0) + rows
+        self.insert_latency.setdefault(table, []).append(latency)
+
+    def sample_queue(self, media_type: str) -> None:
+        self.queue_samples.setdefault(media_type, []).append(self.queues[media_type].qsize())
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def progress(self) -> str:
+        elapsed = self.elapsed()
+        imported = " | ".join(
+            f"{media_type}: {count} ({count / elapsed:.1f}/s)" for media_type, count in self.imported.items()
+        )
+        queues = " ".join(f"{media_type}={queue.qsize()}" for media_type, queue in self.queues.items())
+        return (
+            f"{Fore.YELLOW}PROGRESS {Fore.WHITE}{elapsed:.0f}s{Style.RESET_ALL} | {imported or 'nothing yet'} "
+            f"| pages: {self.pages_fetched} | rows: {sum(self.rows.values())} | queues: {queues}"
+        )
+
+    def summary(self) -> dict:
+        elapsed = self.elapsed()
+        all_inserts = [latency for latencies in self.insert_latency.values() for latency in latencies]
+        queue_fill = {
+            media_type: statistics.fmean(samples) / MEDIA_QUEUE_SIZE
+            for media_type, samples in self.queue_samples.items() if samples
+        }
+        # Full queues mean the fetcher is waiting on the inserters, empty ones the opposite
+        bottleneck = {
+            media_type: "insert" if fill > 0.5 else "fetch" for media_type, fill in queue_fill.items()
+        }
+        return {
+            "elapsed_seconds": round(elapsed, 3),
+            "imported": self.imported,
+            "media_per_second": round(sum(self.imported.values()) / elapsed, 2) if elapsed else 0,
+            "pages_fetched": self.pages_fetched,
+            "graphql_latency_ms": latency_percentiles(self.graphql_latency),
+            "rows_inserted": self.rows,
+            "insert_latency_ms": latency_percentiles(all_inserts),
+            "insert_latency_ms_per_table": {
+                table: latency_percentiles(latencies) for table, latencies in self.insert_latency.items()
+            },
+            "average_queue_fill": {media_type: round(fill, 3) for media_type, fill in queue_fill.items()},
+            "bottleneck": bottleneck,
+            "phases_seconds": {phase: round(seconds, 3) for phase, seconds in self.phases.items()},
+        }
+
+
+def latency_percentiles(samples: typing.List[float]) -> dict:
+    if not samples:
+        return {}
+    if len(samples) == 1:
+        cuts = samples * 99
+    else:
+        cuts = statistics.quantiles(samples, n=100, method="inclusive")
+    return {
+        "count": len(samples),
+        "p50": round(cuts[49] * 1000, 3),
+        "p90": round(cuts[89] * 1000, 3),
+        "p99": round(cuts[98] * 1000, 3),
+        "max": round(max(samples) * 1000, 3),
+    }
+
+
+metrics = ImportMetrics()
+# Table each insert query writes to, used as metrics key
+query_tables: typing.Dict[str, str] = {}
+
+
+def query_table(query: str) -> str:
+    table = query_tables.get(query)
+    if table is None:
+        table = re.search(r"INSERT INTO public\.(\w+)", query).group(1)
+        query_tables[query] = table
+    return table
+
+
+async def execute(db: asyncpg.Pool, query: str, *args):
+    started = time.perf_counter()
+    result = await db.execute(query, *args)
+    metrics.record_insert(query_table(query), 1, time.perf_counter() - started)
+    return result
+
+
+async def executemany(db: asyncpg.Pool, query: str, rows: typing.List[tuple]):
+    started = time.perf_counter()
+    result = await db.executemany(query, rows)
+    metrics.record_insert(query_table(query), len(rows), time.perf_counter() - started)
+    return result
+
+
+async def post_graphql(kitsu_client: askitsu.Client, payload: dict) -> dict:
+    started = time.perf_counter()
+    data = await kitsu_client.http.post_data(payload)
+    metrics.graphql_latency.append(time.perf_counter() - started)
+    metrics.pages_fetched += 1
+    return data
+
+
+async def report_progress(done: asyncio.Event):
+    while not done.is_set():
+        try:
+            await asyncio.wait_for(done.wait(), PROGRESS_INTERVAL)
+        except asyncio.TimeoutError:
+            print(metrics.progress())
 
 
-async def get_anime(kitsu_client: askitsu.Client):
-    global next_cursor
-    global anime
-    data = await kitsu_client.http.post_data(
-        {"query": gqlquery, "variables": {"cursor": next_cursor}}
+# Tables we write to, their secondary indexes and FK triggers are turned off in fast-load mode
+FAST_LOAD_TABLES = [
+    "categories",
+    "anime",
+    "manga",
+    "anime_genres",
+    "genres_manga",
+    "characters",
+    "castings",
+    "anime_characters",
+    "media_characters",
+]
+# Where the dropped index definitions are kept until they're rebuilt, so they can
+# still be restored if the import gets killed halfway. Next to the script, so the
+# next run finds it whatever folder it's started from
+FAST_LOAD_STATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fast_load_state.json")
+
+# Unique indexes are kept: the importer relies on them to reject duplicate rows
+query_secondary_indexes = """
+  SELECT i.indexname, i.indexdef
+  FROM pg_indexes i
+  JOIN pg_index x ON x.indexrelid = format('%I.%I', i.schemaname, i.indexname)::regclass
+  WHERE i.schemaname = 'public'
+    AND i.tablename = ANY($1::text[])
+    AND NOT x.indisunique
+    AND NOT EXISTS (
+      SELECT 1 FROM pg_constraint c
+      WHERE c.conindid = x.indexrelid
+    )
+"""
+
+# The foreign keys of the given tables, with their columns in order
+query_foreign_keys = """
+  SELECT c.conname, c.conrelid::regclass::text AS tablename, c.confrelid::regclass::text AS reftable,
+    array_agg(a.attname ORDER BY k.n) AS columns, array_agg(r.attname ORDER BY k.n) AS refcolumns
+  FROM pg_constraint c
+  CROSS JOIN LATERAL unnest(c.conkey, c.confkey) WITH ORDINALITY AS k(col, refcol, n)
+  JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = k.col
+  JOIN pg_attribute r ON r.attrelid = c.confrelid AND r.attnum = k.refcol
+  WHERE c.contype = 'f'
+    AND c.connamespace = 'public'::regnamespace
+    AND c.conrelid::regclass::text = ANY($1::text[])
+  GROUP BY c.conname, c.conrelid, c.confrelid
+"""
+
+
+@contextlib.asynccontextmanager
+async def timed_phase(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.phases[name] = metrics.phases.get(name, 0) + time.perf_counter() - started
+        print(f"{Fore.YELLOW}PHASE {Fore.WHITE}{name}{Style.RESET_ALL} took {Fore.CYAN}{metrics.phases[name]:.2f}s{Style.RESET_ALL}")
+
+
+async def check_references(db: asyncpg.Pool, tables: typing.List[str]) -> typing.Dict[str, int]:
+    # FK triggers were off while loading, so rows pointing to missing parents were
+    # not rejected. Returns how many rows break each foreign key
+    dangling = {}
+    for fk in await db.fetch(query_foreign_keys, tables):
+        not_null = " AND ".join(f't."{column}" IS NOT NULL' for column in fk["columns"])
+        matches = " AND ".join(f'r."{refcolumn}" = t."{column}"' for column, refcolumn in zip(fk["columns"], fk["refcolumns"]))
+        count = await db.fetchval(
+            f'SELECT count(*) FROM {fk["tablename"]} t WHERE {not_null} '
+            f'AND NOT EXISTS (SELECT 1 FROM {fk["reftable"]} r WHERE {matches})'
+        )
+        if count:
+            dangling[f'{fk["tablename"]}.{fk["conname"]}'] = count
+    return dangling
+
+
+async def restore_fast_load(db: asyncpg.Pool, state: dict) -> int:
+    # Every step runs even if the ones before failed, so the triggers are always
+    # turned back on. Failures are collected and reported at the end.
+    # Returns how many indexes were rebuilt
+    failures = []
+
+    # Indexes are independent, so they're rebuilt at the same time over the pool
+    async with timed_phase("rebuild indexes"):
+        definitions = list(state["indexes"].values())
+        results = await asyncio.gather(*(
+            db.execute(re.sub(r"^CREATE (UNIQUE )?INDEX ", r"CREATE \1INDEX IF NOT EXISTS ", definition))
+            for definition in definitions
+        ), return_exceptions=True)
+        failures += [(definition, result) for definition, result in zip(definitions, results) if isinstance(result, Exception)]
+        rebuilt = len(definitions) - len(failures)
+    async with timed_phase("enable constraints"):
+        for table in state["tables"]:
+            try:
+                await db.execute(f'ALTER TABLE public."{table}" ENABLE TRIGGER ALL')
+            except Exception as e:
+                failures.append((f"ENABLE TRIGGER ALL on {table}", e))
+    async with timed_phase("check references"):
+        try:
+            dangling = await check_references(db, state["tables"])
+        except Exception as e:
+            failures.append(("reference check", e))
+            dangling = {}
+    async with timed_phase("analyze"):
+        results = await asyncio.gather(*(db.execute(f'ANALYZE public."{table}"') for table in state["tables"]), return_exceptions=True)
+        failures += [(f"ANALYZE {table}", result) for table, result in zip(state["tables"], results) if isinstance(result, Exception)]
+
+    if os.path.exists(FAST_LOAD_STATE):
+        os.remove(FAST_LOAD_STATE)
+    for constraint, count in dangling.items():
+        print(f"{Fore.RED}@ Fast-load: {count} rows break {constraint}, normal mode would have rejected them.{Style.RESET_ALL}")
+    for step, error in failures:
+        print(f"{Fore.RED}@ Fast-load: could not restore: {step}\n  {type(error).__name__}: {error}{Style.RESET_ALL}")
+    return rebuilt
+
+
+async def restore_killed_fast_load(db: asyncpg.Pool):
+    # A previous fast-load run died before restoring, its indexes are still dropped
+    # and its triggers disabled. Checked on every run, not only in fast-load mode
+    if not os.path.exists(FAST_LOAD_STATE):
+        return
+    print(f"{Fore.RED}Restoring indexes and triggers left over by a previous fast-load run.{Style.RESET_ALL}")
+    with open(FAST_LOAD_STATE) as f:
+        state = json.load(f)
+    rebuilt = await restore_fast_load(db, state)
+    print(f"@ Fast-load: rebuilt {Fore.GREEN}{rebuilt}/{len(state['indexes'])}{Style.RESET_ALL} leftover indexes.")
+
+
+@contextlib.asynccontextmanager
+async def fast_load(db: asyncpg.Pool, tables: typing.List[str]):
+    state = {"tables": tables, "indexes": {}}
+    try:
+        async with timed_phase("drop indexes"):
+            state["indexes"] = {row["indexname"]: row["indexdef"] for row in await db.fetch(query_secondary_indexes, tables)}
+            with open(FAST_LOAD_STATE, "w") as f:
+                json.dump(state, f)
+            for index in state["indexes"]:
+                await db.execute(f'DROP INDEX IF EXISTS public."{index}"')
+        # Disabling all triggers turns off FK checks too (needs a superuser, like the dev env one)
+        async with timed_phase("disable constraints"):
+            for table in tables:
+                await db.execute(f'ALTER TABLE public."{table}" DISABLE TRIGGER ALL')
+        print(f"@ Fast-load: dropped {Fore.RED}{len(state['indexes'])}{Style.RESET_ALL} indexes and disabled FK checks.")
+
+        async with timed_phase("load"):
+            yield
+    finally:
+        rebuilt = await restore_fast_load(db, state)
+        print(f"@ Fast-load: rebuilt {Fore.GREEN}{rebuilt}/{len(state['indexes'])}{Style.RESET_ALL} indexes and analyzed the tables.")
+
+
+media_queries = {"anime": gqlquery, "manga": manga_gqlquery}
+media_models = {"anime": askitsu.Anime, "manga": askitsu.Manga}
+media_insert_queries = {"anime": query_anime, "manga": query_manga}
+media_genre_queries = {"anime": query_genres, "manga": query_manga_genres}
+media_colors = {"anime": Fore.GREEN, "manga": Fore.MAGENTA}
+Media = typing.Union[askitsu.Anime, askitsu.Manga]
+
+
+async def fetch_media_page(kitsu_client: askitsu.Client, media_type: str) -> typing.List[dict]:
+    data = await post_graphql(
+        kitsu_client, {"query": media_queries[media_type], "variables": {"cursor": next_cursor[media_type]}}
     )
-    next_cursor = data["data"]["anime"]["edges"][-1]["cursor"]
-    animes = data["data"]["anime"]["nodes"]
-    anime_gen = [
-        askitsu.Anime(anime_data, kitsu_client.http, kitsu_client.http._cache)
-        for anime_data in animes
-    ]
-    for i in anime_gen:
-        #Filter any data that may cause problems
-        #or that is not useful
+    next_cursor[media_type] = data["data"][media_type]["edges"][-1]["cursor"]
+    return data["data"][media_type]["nodes"]
+
+
+def build_media(nodes: typing.Iterable[dict], media_type: str, http=None, cache=None) -> typing.Iterator[Media]:
+    for media_data in nodes:
+        i = media_models[media_type](media_data, http, cache)
+        # Filter any data that may cause problems
+        # or that is not useful
         if i.description is None:
-            anime_gen.remove(i)
+            continue
         elif i._attributes["ageRating"] is None:
-            anime_gen.remove(i)
-        elif i.ended_at is None or i.started_at is None:
-            anime_gen.remove(i)
-    anime += anime_gen
-    print(f"Fetched {Fore.RED}{len(anime_gen)}{Style.RESET_ALL} anime.")
+            continue
+        elif i._attributes["endDate"] is None or i._attributes["startDate"] is None:
+            continue
+        yield i
 
 
-async def convert_media_images(image_data: dict) -> typing.Optional[dict]:
+def convert_media_images(image_data: dict) -> typing.Optional[dict]:
     if not image_data:
         return None
-    id = str(image_data["original"]["url"])[23::]
-    # print(id)
+    id = image_data["original"]["url"][MEDIA_URL_PREFIX_LENGTH:]
 
-    derivates_name = [image_size["name"] for image_size in image_data["views"]]
     derivates = {
-        name: {
-            "id": str(image["url"])[23::],
+        image["name"]: {
+            "id": image["url"][MEDIA_URL_PREFIX_LENGTH:],
             "storage": "store",
             "metadata": {
                 "width": image["width"],
@@ -350,7 +676,7 @@ async def convert_media_images(image_data: dict) -> typing.Optional[dict]:
                 # "blurhash": image["blurhash"]
             },
         }
-        for name, image in zip(derivates_name, image_data["views"])
+        for image in image_data["views"]
     }
     new_dict = {
         "id": id,
@@ -362,212 +688,416 @@ async def convert_media_images(image_data: dict) -> typing.Optional[dict]:
         },
         "derivates": derivates,
     }
-    # print(new_dict)
     return new_dict
 
 
+def encode_media_images(image_data: dict, memoize: bool = False) -> str:
+    # The same character shows up in many anime, so with memoize the already encoded
+    # column value is cached using the original image url as key. Posters and banners
+    # belong to a single media, caching them would only fill the cache
+    if not image_data:
+        return "null"
+    if not memoize:
+        return dump_json(convert_media_images(image_data))
+    url = image_data["original"]["url"]
+    encoded = image_cache.get(url)
+    if encoded is None:
+        encoded = dump_json(convert_media_images(image_data))
+        if len(image_cache) >= IMAGE_CACHE_SIZE:
+            del image_cache[next(iter(image_cache))]
+        image_cache[url] = encoded
+    return encoded
+
+
+def snapshot_shards(path: str, name: str) -> typing.List[str]:
+    # The shard files of a snapshot, in order
+    shard = re.compile(rf"{re.escape(name)}-\d{{5}}\.jsonl(\.gz)?")
+    return sorted(file for file in os.listdir(path) if shard.fullmatch(file))
+
+
+def write_snapshot(path: str, name: str, records: typing.Iterable[dict], compress: bool = True) -> int:
+    # Records are written as line-delimited JSON, split in shards of SNAPSHOT_SHARD_SIZE
+    # lines named <name>-<shard>.jsonl(.gz) so they can be streamed back one by one
+    os.makedirs(path, exist_ok=True)
+    # The shards of a previous export would be read back together with the new ones
+    for file in snapshot_shards(path, name):
+        os.remove(os.path.join(path, file))
+    written = 0
+    shard = None
+    try:
+        for record in records:
+            if written % SNAPSHOT_SHARD_SIZE == 0:
+                if shard is not None:
+                    shard.close()
+                shard_path = os.path.join(path, f"{name}-{written // SNAPSHOT_SHARD_SIZE:05d}.jsonl")
+                shard = gzip.open(f"{shard_path}.gz", "wb") if compress else open(shard_path, "wb")
+            shard.write(dump_json(record).encode() + b"\n")
+            written += 1
+    finally:
+        if shard is not None:
+            shard.close()
+    return written
+
+
+def read_snapshot(path: str, name: str, use_mmap: bool = False) -> typing.Iterator[dict]:
+    for file in snapshot_shards(path, name):
+        shard_path = os.path.join(path, file)
+        with open(shard_path, "rb") as f:
+            # Memory mapping lets the kernel page in the shard instead of copying it
+            # through read() calls, mmap refuses empty files so we skip those
+            mapped = None
+            if use_mmap and os.path.getsize(shard_path) > 0:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            source = mapped or f
+            if file.endswith(".gz"):
+                source = gzip.GzipFile(fileobj=source, mode="rb")
+            try:
+                for line in iter(source.readline, b""):
+                    if line.strip():
+                        yield json.loads(line)
+            finally:
+                if source is not f:
+                    source.close()
+                if mapped is not None:
+                    mapped.close()
+
+
+async def export_snapshot(path: str, pages: int, media_types: typing.List[str], compress: bool = True):
+    try:
+        kitsu = askitsu.Client(cache_expiration=0)
+        print("@ askitsu Client initialized!")
+    except:
+        print("Could not initialize askitsu client.")
+        return
+
+    categories = await post_graphql(kitsu, {"query": categories_gqlquery})
+    written = write_snapshot(path, "categories", categories["data"]["categories"]["nodes"], compress)
+    print(f"Exported {Fore.RED}{written}{Style.RESET_ALL} categories.")
+
+    # Characters are exported nested inside their media, as returned by GraphQL
+    for media_type in media_types:
+        nodes = []
+        for _ in range(pages):
+            nodes += await fetch_media_page(kitsu, media_type)
+            print(f"Fetched {Fore.RED}{len(nodes)}{Style.RESET_ALL} {media_type}.")
+        written = write_snapshot(path, media_type, nodes, compress)
+        print(f"Exported {Fore.RED}{written}{Style.RESET_ALL} {media_type} to {Fore.CYAN}{path}{Style.RESET_ALL}.")
+
+    await kitsu.close()
+
+
 async def convert_to_datetime(timestamp: str) -> datetime:
     return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")
 
 
-async def match_canonical_title(titles: dict) -> str:
+def match_canonical_title(titles: dict) -> str:
     if "en_jp" in titles:
       return "en_jp"
     return next(iter(titles))
 
-async def run():
-    global id
+
+def convert_titles(titles: dict) -> str:
+    converted = ""
+    for key, value in titles.items():
+        if value:
+            format_str = '"{0}"=>"{1}",'.format(key, value)
+            converted += format_str
+    return converted
+
+
+async def insert_categories(db: asyncpg.Pool, categories: typing.Iterable[dict], categories_ready: asyncio.Event):
+    try:
+        rows = []
+        for cid, category in enumerate(categories):
+            try:
+                parent_id = category["parent"]
+                if parent_id is not None:
+                    parent_id = int(parent_id.get("id", None))
+                rows.append((
+                    cid,
+                    category["title"].get("en", ""),
+                    category["slug"],
+                    parent_id,
+                    category["isNsfw"],
+                    await convert_to_datetime(category["createdAt"]),
+                    await convert_to_datetime(category["updatedAt"]),
+                    category["children"]["totalCount"],
+                    dump_json(category["description"].get("en", "")),
+                ))
+            except Exception as e:
+                print(f"Skip category: {Fore.RED}{category['slug']}{Style.RESET_ALL}.", e)
+
+        # Insert all of them at once, if any row is rejected fall back to
+        # one by one so only the broken categories are skipped
+        try:
+            await executemany(db, query_categories, rows)
+            print(f"Added {Fore.GREEN}{len(rows)}{Style.RESET_ALL} categories.")
+        except Exception:
+            for row in rows:
+                try:
+                    await execute(db, query_categories, *row)
+                    print(f"Add category: {Fore.GREEN}{row[2]}{Style.RESET_ALL}.")
+                except Exception as e:
+                    print(f"Skip category: {Fore.RED}{row[2]}{Style.RESET_ALL}.", e)
+    finally:
+        # Genres reference categories, whatever happened the media inserters can go on now
+        categories_ready.set()
+
+
+async def insert_genres(db: asyncpg.Pool, query: str, media_id: int, media: Media, categories_ready: asyncio.Event):
+    await categories_ready.wait()
+    for genres in media._attributes["categories"]["nodes"]:
+        try:
+            await execute(db, query, media_id, int(genres["id"]))
+        except:
+            pass
+
+
+async def insert_characters(db: asyncpg.Pool, media_id: int, media_type: str, media: Media) -> bool:
+    global character_id
+    characters_added = False
+    for characters in media._attributes["characters"]["nodes"]:
+        # Reserved before awaiting, like the media ids
+        cid = character_id
+        character_id += 1
+        try:
+            await execute(
+                db,
+                query_character,
+                cid,
+                characters["character"]["names"]["canonical"],
+                datetime.strptime(
+                    characters["character"]["createdAt"], "%Y-%m-%dT%H:%M:%SZ"
+                ),
+                datetime.strptime(
+                    characters["character"]["updatedAt"], "%Y-%m-%dT%H:%M:%SZ"
+                ),
+                characters["character"]["slug"],
+                dump_json(characters["character"]["description"]),
+                match_canonical_title(characters["character"]["names"]["localized"]),
+                media_id,
+                media_type,
+                dump_json(characters["character"]["names"]["localized"]),
+                encode_media_images(characters["character"]["image"], memoize=True)
+            )
+            if media_type == "anime":
+                await execute(
+                    db,
+                    query_anime_character,
+                    media_id,
+                    cid,
+                    CharacterRole[characters["role"]].value,
+                    datetime.strptime(
+                        characters["createdAt"], "%Y-%m-%dT%H:%M:%SZ"
+                    ),
+                    datetime.strptime(
+                        characters["updatedAt"], "%Y-%m-%dT%H:%M:%SZ"
+                    ),
+                )
+            await execute(
+                db,
+                query_media_character,
+                media_id,
+                media_type,
+                cid,
+                CharacterRole[characters["role"]].value,
+                datetime.strptime(
+                    characters["createdAt"], "%Y-%m-%dT%H:%M:%SZ"
+                ),
+                datetime.strptime(
+                    characters["updatedAt"], "%Y-%m-%dT%H:%M:%SZ"
+                ),
+            )
+            await execute(
+              db,
+              query_casting,
+              cid,
+              media_id,
+              cid,
+              "Producer",
+              await convert_to_datetime(characters["createdAt"]),
+              await convert_to_datetime(characters["updatedAt"]),
+              True,
+              True,
+              "En",
+              media_type.capitalize()
+            )
+            characters_added = True
+        except:
+            pass
+    return characters_added
+
+
+async def insert_media(db: asyncpg.Pool, media_type: str, media: Media, categories_ready: asyncio.Event):
     global imports
-    character_id = 1
+    # Reserve the id before awaiting, other inserters share the counter
+    media_id = next_id[media_type]
+    next_id[media_type] += 1
+    try:
+        # Convert the data
+        row = [convert(media) for convert in media_columns.values()]
+        row += [convert(media) for convert in media_type_columns[media_type].values()]
+        # Execute the query - Media data
+        await execute(db, media_insert_queries[media_type], media_id, *row)
+
+        # Execute the query - Character
+        characters_added = await insert_characters(db, media_id, media_type, media)
+        # Execute the query - Media Genres
+        await insert_genres(db, media_genre_queries[media_type], media_id, media, categories_ready)
+
+        imports += 1
+        metrics.imported[media_type] = metrics.imported.get(media_type, 0) + 1
+        print(
+            f"{Fore.GREEN}IMPORT: {Fore.WHITE}Insert into db: {media_colors[media_type]}{media.slug}{Style.RESET_ALL} " \
+            f"as {Fore.CYAN}{media_id + 1}{Style.RESET_ALL} " \
+            f"| Characters: {Fore.CYAN if characters_added else Fore.LIGHTRED_EX}{characters_added}{Style.RESET_ALL}"
+        )
+    except Exception as e:
+        # If any error occurs when converting the media data, we skip the media
+        print(f"{Fore.RED}SKIP: {Fore.WHITE}{media.id}{Style.RESET_ALL}: {e}")
+        print(media._attributes)
+
+
+
+
+async def import_categories(db: asyncpg.Pool, kitsu: typing.Optional[askitsu.Client], snapshot: typing.Optional[str], use_mmap: bool, categories_ready: asyncio.Event):
+    try:
+        if snapshot is not None:
+            categories = read_snapshot(snapshot, "categories", use_mmap)
+        else:
+            data = await post_graphql(kitsu, {"query": categories_gqlquery})
+            print(
+                f"Total fetched categories: {Fore.RED}{data['data']['categories']['totalCount']}{Style.RESET_ALL}."
+            )
+            categories = data["data"]["categories"]["nodes"]
+    except Exception as e:
+        print(f"{Fore.RED}Could not fetch categories{Style.RESET_ALL}: {e}")
+        categories_ready.set()
+        return
+    await insert_categories(db, categories, categories_ready)
+
+
+async def import_media(db: asyncpg.Pool, kitsu: typing.Optional[askitsu.Client], media_type: str, snapshot: typing.Optional[str], use_mmap: bool, pages: int, categories_ready: asyncio.Event):
+    queue: asyncio.Queue = asyncio.Queue(maxsize=MEDIA_QUEUE_SIZE)
+    metrics.queues[media_type] = queue
+
+    async def fetch():
+        try:
+            if snapshot is not None:
+                # Shards are read lazily, so only a queue worth of media is in memory at once
+                for media in build_media(read_snapshot(snapshot, media_type, use_mmap), media_type):
+                    await queue.put(media)
+            else:
+                for _ in range(pages):
+                    fetched = 0
+                    for media in build_media(await fetch_media_page(kitsu, media_type), media_type, kitsu.http, kitsu.http._cache):
+                        await queue.put(media)
+                        fetched += 1
+                    print(f"Fetched {Fore.RED}{fetched}{Style.RESET_ALL} {media_type}.")
+        finally:
+            # One stop marker per inserter
+            for _ in range(INSERT_WORKERS):
+                await queue.put(None)
 
+    async def insert_worker():
+        while (media := await queue.get()) is not None:
+            metrics.sample_queue(media_type)
+            await insert_media(db, media_type, media, categories_ready)
+
+    await asyncio.gather(fetch(), *(insert_worker() for _ in range(INSERT_WORKERS)))
+
+
+async def run(snapshot: typing.Optional[str] = None, use_mmap: bool = False, pages: int = 3, media_types: typing.Sequence[str] = ("anime", "manga"), metrics_path: typing.Optional[str] = None, use_fast_load: bool = False):
     # Initialize
     try:
         db = await asyncpg.create_pool(
-            database=KITSU_DB_NAME, user=KITSU_DB_USER, host=HOST, port="5432"
+            database=KITSU_DB_NAME, user=KITSU_DB_USER, host=HOST, port="5432",
+            max_size=INSERT_WORKERS * len(media_types) + 1,
         )
         print("@ CONNECTED TO DB")
     except Exception as e:
         print("Could not connect to DB.")
         traceback.print_exc()
         return
+
     try:
-        kitsu = askitsu.Client(cache_expiration=0)
-        print("@ askitsu Client initialized!")
-    except:
-        print("Could not initialize askitsu client.")
+        await restore_killed_fast_load(db)
+    except Exception:
+        print(f"{Fore.RED}Could not restore the previous fast-load run, see {FAST_LOAD_STATE}.{Style.RESET_ALL}")
+        traceback.print_exc()
+        await db.close()
         return
 
-    # Fetch categories
-    categories = await kitsu.http.post_data({"query": categories_gqlquery})
-    print(
-        f"Total fetched categories: {Fore.RED}{categories['data']['categories']['totalCount']}{Style.RESET_ALL}."
-    )
-    for cid, category in enumerate(categories["data"]["categories"]["nodes"]):
+    # Offline mode: stream everything from the local snapshot, no network needed
+    kitsu = None
+    if snapshot is not None:
+        print(f"@ Importing from snapshot {Fore.CYAN}{snapshot}{Style.RESET_ALL}")
+    else:
         try:
-            parent_id = category["parent"]
-            if parent_id is not None:
-                parent_id = int(parent_id.get("id", None))
-            await db.execute(
-                query_categories,
-                cid,
-                category["title"].get("en", ""),
-                category["slug"],
-                parent_id,
-                category["isNsfw"],
-                await convert_to_datetime(category["createdAt"]),
-                await convert_to_datetime(category["updatedAt"]),
-                category["children"]["totalCount"],
-                json.dumps(category["description"].get("en", "")),
-            )
-            print(f"Add category: {Fore.GREEN}{category['slug']}{Style.RESET_ALL}.")
-        except Exception as e:
-            print(f"Skip category: {Fore.RED}{category['slug']}{Style.RESET_ALL}.", e)
+            kitsu = askitsu.Client(cache_expiration=0)
+            print("@ askitsu Client initialized!")
+        except:
+            print("Could not initialize askitsu client.")
+            await db.close()
+            return
 
-    # Fetch a bunch of anime
-    for _ in range(3):
-        await get_anime(kitsu_client=kitsu)
+    # Categories and every media type are imported at the same time, the only
+    # ordering we need is that genres are inserted after the categories they point to
+    categories_ready = asyncio.Event()
+    metrics.started = time.perf_counter()
+    done = asyncio.Event()
+    progress = asyncio.create_task(report_progress(done))
+    try:
+        async with fast_load(db, FAST_LOAD_TABLES) if use_fast_load else contextlib.nullcontext():
+            results = await asyncio.gather(
+                import_categories(db, kitsu, snapshot, use_mmap, categories_ready),
+                *(import_media(db, kitsu, media_type, snapshot, use_mmap, pages, categories_ready) for media_type in media_types),
+                return_exceptions=True,
+            )
+            for result in results:
+                if isinstance(result, Exception):
+                    print(f"{Fore.RED}Import task failed{Style.RESET_ALL}: {result!r}")
+    except Exception:
+        print(f"{Fore.RED}Fast-load failed.{Style.RESET_ALL}")
+        traceback.print_exc()
+    done.set()
+    await progress
 
-    print(f"Total fetched anime: {Fore.RED}{len(anime)}{Style.RESET_ALL}.")
+    # Close DB and askitsu connections
+    await db.close()
+    if kitsu is not None:
+        await kitsu.close()
+    print(f"Imported {imports} media into db")
 
-    # Add the data to the database
-    for media in anime:
-        try:
-            # Convert the data
-            characters_added: bool = False
-            
-
-            poster_image = await convert_media_images(media._attributes["posterImage"])
-            cover_image = await convert_media_images(media._attributes["bannerImage"])
-            age_rating = media._attributes["ageRating"]
-            if age_rating is not None:
-                age_rating = AgeRating[media.age_rating].value
-            titles = ""
-            for key, value in media._titles.items():
-                if value:
-                    format_str = '"{0}"=>"{1}",'.format(key, value)
-                    titles += format_str
-            # Execute the query - Anime data
-            await db.execute(
-                query_anime,
-                id,
-                media.slug,
-                age_rating,
-                media.episode_count,
-                media.episode_length,
-                json.dumps({"en": media.description}),
-                media.yt_id,
-                media.created_at,
-                media.updated_at,
-                media.rating,
-                media._attributes.get("userCount", 0),
-                media._attributes.get("ageRatingGuide", ""),
-                Subtype[media.subtype].value,
-                media.started_at,
-                media.ended_at,
-                titles,
-                await match_canonical_title(media._titles),
-                media.popularity_rank,
-                media.rating_rank,
-                media._attributes.get("favoritesCount", 0),
-                media._attributes.get("tba", ""),
-                media.episode_count,
-                media.total_length,
-                media._attributes.get("origin_languages", None),
-                media._attributes.get("origin_countries", None),
-                media._attributes.get("original_locale", ""),
-                json.dumps(poster_image),
-                json.dumps(cover_image),
-            )
+    summary = json.dumps(metrics.summary(), indent=2)
+    print(summary)
+    if metrics_path is not None:
+        with open(metrics_path, "w") as f:
+            f.write(summary)
 
-            # Execute the query - Anime Genres
-            for genres in media._attributes["categories"]["nodes"]:
-                try:
-                    await db.execute(query_genres, id, int(genres["id"]))
-                except:
-                    pass
 
-            # Execute the query - Character
-            for characters in media._attributes["characters"]["nodes"]:
-                try:
-                    await db.execute(
-                        query_character,
-                        character_id,
-                        characters["character"]["names"]["canonical"],
-                        datetime.strptime(
-                            characters["character"]["createdAt"], "%Y-%m-%dT%H:%M:%SZ"
-                        ),
-                        datetime.strptime(
-                            characters["character"]["updatedAt"], "%Y-%m-%dT%H:%M:%SZ"
-                        ),
-                        characters["character"]["slug"],
-                        json.dumps(characters["character"]["description"]),
-                        await match_canonical_title(characters["character"]["names"]["localized"]),
-                        id,
-                        "anime",
-                        json.dumps(characters["character"]["names"]["localized"]),
-                        json.dumps(await convert_media_images(characters["character"]["image"]))
-                    )
-                    await db.execute(
-                        query_anime_character,
-                        id,
-                        character_id,
-                        CharacterRole[characters["role"]].value,
-                        datetime.strptime(
-                            characters["createdAt"], "%Y-%m-%dT%H:%M:%SZ"
-                        ),
-                        datetime.strptime(
-                            characters["updatedAt"], "%Y-%m-%dT%H:%M:%SZ"
-                        ),
-                    )
-                    await db.execute(
-                        query_media_character,
-                        id,
-                        "anime",
-                        character_id,
-                        CharacterRole[characters["role"]].value,
-                        datetime.strptime(
-                            characters["createdAt"], "%Y-%m-%dT%H:%M:%SZ"
-                        ),
-                        datetime.strptime(
-                            characters["updatedAt"], "%Y-%m-%dT%H:%M:%SZ"
-                        ),
-                    )
-                    await db.execute(
-                      query_casting,
-                      character_id,
-                      id,
-                      character_id,
-                      "Producer",
-                      await convert_to_datetime(characters["createdAt"]),
-                      await convert_to_datetime(characters["updatedAt"]),
-                      True,
-                      True,
-                      "En",
-                      "Anime"
-                    )
-                    character_id += 1
-                    characters_added = True
-                except:
-                    pass
-
-            id += 1
-            imports += 1
-            print(
-                f"{Fore.GREEN}IMPORT: {Fore.WHITE}Insert into db: {Fore.GREEN}{media.slug}{Style.RESET_ALL} " \
-                f"as {Fore.CYAN}{id}{Style.RESET_ALL} " \
-                f"| Characters: {Fore.CYAN if characters_added else Fore.LIGHTRED_EX}{characters_added}{Style.RESET_ALL}"
-            )
-        except Exception as e:
-            # If any error occurs when converting the anime data, we skip the anime
-            print(f"{Fore.RED}SKIP: {Fore.WHITE}{media.id}{Style.RESET_ALL}: {e}")
-            print(media._attributes)
-    anime.remove(media)
+def parse_args() -> None:
+    parser = argparse.ArgumentParser(
+        description="Import sample media data into your kitsu dev env database."
+    )
+    parser.add_argument("--pages", "-p", type=int, default=3, help="How many pages (20 media each) to fetch from GraphQL, per media type.")
+    parser.add_argument("--media", "-m", nargs="+", choices=list(media_queries), default=list(media_queries), help="Which media types to import.")
+    parser.add_argument("--export", "-e", type=str, help="Fetch the data and save it as a local snapshot in the given folder, without touching the DB.")
+    parser.add_argument("--no-compress", action="store_true", help="Write plain .jsonl shards instead of gzipped ones when exporting.")
+    parser.add_argument("--snapshot", "-s", type=str, help="Import from a local snapshot folder instead of the live GraphQL API.")
+    parser.add_argument("--mmap", action="store_true", help="Memory-map the snapshot shards while importing.")
+    parser.add_argument("--fast-load", action="store_true", help="Drop secondary indexes and disable FK checks while importing, then rebuild them.")
+    parser.add_argument("--metrics", type=str, help="Also write the final JSON metrics summary to the given file.")
 
-    # Close DB and askitsu connections
-    await db.close()
-    await kitsu.close()
-    print(f"Imported {imports} anime into db")
+    args = parser.parse_args()
 
+    if args.export is not None:
+        asyncio.run(export_snapshot(args.export, args.pages, args.media, not args.no_compress))
+        return
+    if args.snapshot is not None and not os.path.isdir(args.snapshot):
+        sys.exit(f"The provided snapshot does not exist: '{args.snapshot}'")
+    asyncio.run(run(args.snapshot, args.mmap, args.pages, args.media, args.metrics, args.fast_load))
 
-asyncio.run(run())
 
+if __name__ == "__main__":
+    parse_args()